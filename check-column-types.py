@@ -1,14 +1,25 @@
 #!/usr/bin/env python3
 
+import re
 import sqlite3
 import sys
 
+import pyarrow as pa
+import pyarrow.compute as pc
+
 DB_PATH = "telefonbuch-scrape.db"
 TABLE_NAME = "telefonbuch_scrape"
 
 # on error, show only the first N bad rows
 error_num_rows = 100
 
+# number of rows per fetchmany
+chunk_num_rows = 100_000
+
+# a CHECK constraint in the CREATE TABLE statement
+# not just "check" somewhere in an identifier
+check_constraint_regex = re.compile(r"\bCHECK\s*\(", re.IGNORECASE)
+
 telefonbuch_columns = {
     "name0": str,
     "firstname0": str,
@@ -44,29 +55,69 @@ def main():
         conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
 
-        # --- Identify boolean and enum columns ---
-        bool_cols = [col for col, typ in telefonbuch_columns.items() if typ is bool]
-        enum_cols = {col: vals for col, vals in telefonbuch_columns.items() if isinstance(typ := telefonbuch_columns[col], tuple)}
-
-        # --- Build WHERE conditions ---
-        conditions = []
+        # --- Fast path: column types are enforced by CHECK constraints ---
+        # then the rows were validated at insert time
+        # and quick_check only has to confirm that
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (TABLE_NAME,))
+        row = cursor.fetchone()
+        if row is None:
+            print(f"SQLite error: no such table: {TABLE_NAME}")
+            sys.exit(1)
+        table_sql = row[0]
+        if check_constraint_regex.search(table_sql):
+            cursor.execute(f"PRAGMA quick_check({TABLE_NAME})")
+            if cursor.fetchall() == [("ok",)]:
+                print(f"ok: all column types are valid")
+                sys.exit(0)
+            # show the bad rows
+
+        # --- Get declared column types ---
+        cursor.execute(f"PRAGMA table_info({TABLE_NAME})")
+        declared_types = {row[1]: row[2].upper() for row in cursor.fetchall()}
 
-        # Boolean columns: must be 'true' or 'false'
+        # --- Identify boolean and enum columns ---
+        bool_cols = [col for col, typ in telefonbuch_columns.items() if typ is bool and col in declared_types]
+        enum_cols = {col: vals for col, vals in telefonbuch_columns.items() if isinstance(typ := telefonbuch_columns[col], tuple) and col in declared_types}
+
+        # --- Allowed values per column ---
+        # telefonbuch-scraper.py stores 'true' or 'false' as TEXT
+        # csv2sqlite.py stores 0 or 1 as INTEGER
+        # all values are compared as text, so one string kernel fits all columns
+        allowed_values = {}
         for col in bool_cols:
-            conditions.append(f"({col} != 'true' AND {col} != 'false')")
-
-        # Enum columns: must be in given allowed values
-        for col, allowed_values in enum_cols.items():
-            allowed_list = ", ".join(f"'{v}'" for v in allowed_values)
-            conditions.append(f"({col} NOT IN ({allowed_list}))")
-
-        # Combine all into one WHERE clause
-        where_clause = " OR ".join(conditions)
-        query = f"SELECT * FROM {TABLE_NAME} WHERE {where_clause} LIMIT {error_num_rows}"
+            if declared_types[col] == "TEXT":
+                allowed_values[col] = pa.array(["true", "false"])
+            else:
+                allowed_values[col] = pa.array(["0", "1"])
+        for col, values in enum_cols.items():
+            allowed_values[col] = pa.array(list(values))
+        check_cols = list(allowed_values)
+        if not check_cols:
+            print(f"ok: no boolean or enum columns to check")
+            sys.exit(0)
 
-        # --- Execute ---
-        cursor.execute(query)
-        bad_rows = cursor.fetchall()
+        # --- Scan in chunks, validate columnwise with pyarrow ---
+        select_list = ", ".join(f"CAST({col} AS TEXT)" for col in check_cols)
+        cursor.execute(f"SELECT rowid, {select_list} FROM {TABLE_NAME}")
+        bad_rowids = []
+        while len(bad_rowids) < error_num_rows:
+            rows = cursor.fetchmany(chunk_num_rows)
+            if not rows:
+                break
+            rowids, *columns = zip(*rows)
+            bad_mask = None
+            for col, values in zip(check_cols, columns):
+                arr = pa.array(values, type=pa.string())
+                # NULL is not a bad value, same as in "col NOT IN (...)"
+                col_mask = pc.and_(pc.invert(pc.is_in(arr, value_set=allowed_values[col])), pc.is_valid(arr))
+                bad_mask = col_mask if bad_mask is None else pc.or_(bad_mask, col_mask)
+            bad_rowids += pa.array(rowids).filter(bad_mask).to_pylist()
+
+        # --- Fetch the bad rows ---
+        bad_rows = []
+        for rowid in bad_rowids[:error_num_rows]:
+            cursor.execute(f"SELECT * FROM {TABLE_NAME} WHERE rowid = ?", (rowid,))
+            bad_rows.append(cursor.fetchone())
 
         if bad_rows:
             print(f"error: found {len(bad_rows)} bad rows:")
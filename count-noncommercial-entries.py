@@ -1,13 +1,23 @@
 #!/usr/bin/env python3
 
-import csv
+# count in the database created by csv2sqlite.py
+# instead of parsing the whole CSV file in python
 
-count = 0
+import sqlite3
 
-with open("telefonbuch.csv", newline="") as csvfile:
-    reader = csv.DictReader(csvfile, delimiter=";")
-    for row in reader:
-        if row["recordtype_int"] == "0" and row["commercial"] == "" and row["housenumber"] != "":
-            count += 1
+DB_PATH = "telefonbuch.db"
+TABLE_NAME = "telefonbuch"
+
+conn = sqlite3.connect(DB_PATH)
+
+query = f"""
+    SELECT COUNT(*) FROM {TABLE_NAME}
+    WHERE recordtype_int = 0
+    AND commercial = 0
+    AND housenumber != ''
+"""
+count = conn.execute(query).fetchone()[0]
+
+conn.close()
 
 print("Nichtkommerzielle Einträge:", count)
@@ -3,13 +3,22 @@
 
 import os
 import sys
-import csv
+import shutil
 import sqlite3
+import subprocess
+import threading
+import queue
 from pathlib import Path
-from itertools import islice
 
 from tqdm import tqdm
 
+from get_random_address_pairs import (
+    DEFAULT_WHERE_CLAUSE,
+    ELIGIBLE_VIEW_NAME,
+    ELIGIBLE_TABLE_NAME,
+    ELIGIBLE_COLUMNS,
+)
+
 
 telefonbuch_columns = {
     "name0": str,
@@ -49,7 +58,31 @@ sqlite_col_type_map = {
 }
 
 
-def csv_to_sqlite(csv_path, sqlite_path, table_name="records", batch_size=10000):
+def import_csv_with_sqlite_cli(sqlite_cli, csv_path, staging_path, header):
+    """Load the CSV as TEXT columns into a staging database with the sqlite3 shell.
+
+    The shell parses and inserts in C, without Python round-trips.
+    """
+    script = "\n".join([
+        "PRAGMA journal_mode = OFF;",
+        "PRAGMA synchronous = OFF;",
+        f"CREATE TABLE staging ({', '.join(f'{col} TEXT' for col in header)});",
+        ".mode csv",
+        ".separator ;",
+        f'.import --skip 1 "{csv_path}" staging',
+        "",
+    ])
+    # the shell prints the new journal_mode. errors go to stderr
+    subprocess.run(
+        [sqlite_cli, str(staging_path)],
+        input=script,
+        text=True,
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+
+
+def csv_to_sqlite(csv_path, sqlite_path, table_name="records", block_size=16 << 20):
 
     if os.path.exists(sqlite_path):
         print(f"error: output exists: {sqlite_path}")
@@ -61,6 +94,33 @@ def csv_to_sqlite(csv_path, sqlite_path, table_name="records", batch_size=10000)
     conn = sqlite3.connect(sqlite_path)
     cur = conn.cursor()
 
+    # Bulk load settings
+    # this is a one-shot import into a new file,
+    # so on failure we just delete the output and start over
+    # page_size must be set before the first table is created
+    cur.execute("PRAGMA page_size = 65536")
+    cur.execute("PRAGMA journal_mode = OFF")
+    cur.execute("PRAGMA synchronous = OFF")
+    cur.execute("PRAGMA temp_store = MEMORY")
+    cur.execute("PRAGMA cache_size = -262144") # 256 MiB
+    cur.execute("PRAGMA locking_mode = EXCLUSIVE")
+
+    # Read CSV header
+    with csv_path.open("r", encoding="utf-8", newline="") as f:
+        header = f.readline().rstrip("\r\n").split(";")
+
+    # If the sqlite3 shell is installed, let it do the parsing
+    # and only compute parent_id in SQL
+    sqlite_cli = shutil.which("sqlite3")
+    staging_path = sqlite_path.with_name(sqlite_path.name + ".staging")
+    if sqlite_cli:
+        if os.path.exists(staging_path):
+            os.unlink(staging_path)
+        print(f"importing {csv_path} with {sqlite_cli}")
+        import_csv_with_sqlite_cli(sqlite_cli, csv_path, staging_path, header)
+        # ATTACH is not allowed inside a transaction
+        cur.execute("ATTACH DATABASE ? AS staging", (str(staging_path),))
+
     # Lock the database exclusively
     cur.execute("BEGIN EXCLUSIVE")
 
@@ -68,92 +128,214 @@ def csv_to_sqlite(csv_path, sqlite_path, table_name="records", batch_size=10000)
     bytes_per_row = 85.37834685553358
     estimated_rows = int(csv_path.stat().st_size / bytes_per_row)
 
-    # Read CSV header
-    with csv_path.open("r", encoding="utf-8", newline="") as f:
-        reader = csv.reader(f, delimiter=";")
-        header = next(reader)
-
-        # Create SQLite table
-        columns = [
-            "id INTEGER PRIMARY KEY AUTOINCREMENT",
-            "parent_id INTEGER"
-        ]
-        for col in header:
-            col_type = telefonbuch_columns[col]
-            sqlite_col_type = sqlite_col_type_map[col_type]
+    # Create SQLite table
+    columns = [
+        # no AUTOINCREMENT. rowids are still assigned in order
+        # without the sqlite_sequence update on every insert
+        "id INTEGER PRIMARY KEY",
+        "parent_id INTEGER"
+    ]
+    for col in header:
+        col_type = telefonbuch_columns[col]
+        sqlite_col_type = sqlite_col_type_map[col_type]
+        # CHECK constraints, so malformed rows fail at insert time
+        # and check-column-types.py can skip its full scan
+        if col_type == bool:
+            columns.append(f'{col} {sqlite_col_type} CHECK ({col} IN (0, 1))')
+        elif col == "recordtype_int":
+            columns.append(f'{col} {sqlite_col_type} CHECK ({col} IN (0, 1, 2))')
+        else:
             columns.append(f'{col} {sqlite_col_type}')
 
-        batch_row_types = tuple(telefonbuch_columns[col] for col in header)
+    # cur.execute(f"DROP TABLE IF EXISTS {table_name}")
+    cur.execute(f"CREATE TABLE {table_name} (\n  {',\n  '.join(columns)}\n)")
 
-        # cur.execute(f"DROP TABLE IF EXISTS {table_name}")
-        cur.execute(f"CREATE TABLE {table_name} (\n  {',\n  '.join(columns)}\n)")
+    insert_columns = ["parent_id"] + header
+    placeholders = ",".join(["?"] * len(insert_columns))
+    insert_sql = f"INSERT INTO {table_name} ({', '.join(insert_columns)}) VALUES ({placeholders})"
+    recordtype_index = header.index("recordtype_int")
 
-        insert_columns = ["parent_id"] + header
-        placeholders = ",".join(["?"] * len(insert_columns))
-        recordtype_index = header.index("recordtype_int")
+    if sqlite_cli:
+        # convert the TEXT columns like pyarrow does
+        # rowids of the staging table are in file order
+        # so the running MAX is the rowid of the last parent
+        select_columns = []
+        for col in header:
+            col_type = telefonbuch_columns[col]
+            if col_type == bool:
+                select_columns.append(f"{col} = '1'")
+            elif col_type == int:
+                select_columns.append(f"CAST({col} AS INTEGER)")
+            else:
+                select_columns.append(col)
+        cur.execute(
+            f"INSERT INTO {table_name} (id, {', '.join(insert_columns)})\n"
+            "SELECT rowid,\n"
+            "  CASE WHEN recordtype_int = '2' THEN\n"
+            "    MAX(CASE WHEN recordtype_int = '1' THEN rowid END)\n"
+            "    OVER (ORDER BY rowid ROWS UNBOUNDED PRECEDING)\n"
+            "  END,\n"
+            f"  {', '.join(select_columns)}\n"
+            "FROM staging.staging ORDER BY rowid"
+        )
+        total_inserted = cur.rowcount
+
+    else:
+        # only this fallback needs numpy and pyarrow
+        import numpy as np
+        import pyarrow as pa
+        from pyarrow import csv as pacsv
+
+        arrow_col_type_map = {
+            str: pa.string(),
+            int: pa.int64(),
+            bool: pa.bool_(),
+        }
+
+        # Specialize the parser for this header
+        # pyarrow parses and type-casts whole blocks of rows in C++
+        # so there is no per-cell type dispatch in Python
+        column_types = {
+            col: arrow_col_type_map[telefonbuch_columns[col]]
+            for col in header
+        }
+        read_options = pacsv.ReadOptions(block_size=block_size)
+        parse_options = pacsv.ParseOptions(delimiter=";")
+        convert_options = pacsv.ConvertOptions(
+            column_types=column_types,
+            include_columns=header,
+            # empty bool cells are false, not null
+            null_values=[],
+            true_values=["1"],
+            false_values=["0", ""],
+            strings_can_be_null=False,
+        )
+        reader = pacsv.open_csv(
+            csv_path,
+            read_options=read_options,
+            parse_options=parse_options,
+            convert_options=convert_options,
+        )
 
         next_rowid = 1
         last_parent_rowid = None
         total_inserted = 0
 
-        def process_batch(batch_rows, start_rowid, last_parent):
-            """Prepare tuples with parent_id predictions."""
-            data = []
-            next_rowid = start_rowid
-            current_parent = last_parent
-
-            for row in batch_rows:
-                record_type = int(row[recordtype_index])
-
-                if record_type == 1:  # parent
-                    parent_id = None
-                    current_parent = next_rowid
-                elif record_type == 2:  # child
-                    parent_id = current_parent
-                else:  # single
-                    parent_id = None
-
-                for idx, val in enumerate(row):
-                    _type = batch_row_types[idx]
-                    if _type == str:
-                        continue
-                    if _type == bool:
-                        row[idx] = True if val == "1" else False
-                        continue
-                    if _type == int:
-                        row[idx] = int(val)
-                        continue
+        def process_batch(batch, start_rowid, last_parent):
+            """Prepare row tuples with parent_id predictions."""
+            record_types = batch.column(recordtype_index).to_numpy()
+            rowids = np.arange(start_rowid, start_rowid + len(record_types))
+
+            # forward-fill the rowid of the last parent
+            # rowids are increasing, so a running maximum does the fill
+            parent_rowids = np.where(record_types == 1, rowids, 0)
+            parent_rowids[0] = max(parent_rowids[0], last_parent or 0)
+            np.maximum.accumulate(parent_rowids, out=parent_rowids)
+
+            # only children have a parent_id. 0 means "no parent seen yet"
+            parent_ids = pa.array(
+                parent_rowids,
+                mask=(record_types != 2) | (parent_rowids == 0),
+            )
+
+            # the columns are converted here, in the producer thread
+            # the row tuples are built lazily by zip while executemany consumes them
+            # so there is no list of row tuples
+            columns = [parent_ids.to_pylist()] + [c.to_pylist() for c in batch.columns]
+            data = zip(*columns)
 
-                data.append([parent_id] + row)
-                next_rowid += 1
+            next_rowid = start_rowid + len(record_types)
+            current_parent = int(parent_rowids[-1]) or None
 
             return data, next_rowid, current_parent
 
+        # Producer thread: parse and convert the next batches
+        # while the main thread inserts the current one.
+        # sqlite3 releases the GIL while it steps the INSERT statement
+        # next_rowid and last_parent_rowid stay in the producer,
+        # so batches are still processed in file order
+        batch_queue = queue.Queue(maxsize=4)
+
+        def produce_batches():
+            nonlocal next_rowid, last_parent_rowid
+            try:
+                for batch in reader:
+                    if batch.num_rows == 0:
+                        continue
+
+                    data_to_insert, next_rowid, last_parent_rowid = process_batch(
+                        batch, next_rowid, last_parent_rowid
+                    )
+
+                    batch_queue.put((data_to_insert, batch.num_rows))
+
+                    # break # debug: stop after first batch
+
+                batch_queue.put(None)
+            except Exception as exc:
+                batch_queue.put(exc)
+
+        producer = threading.Thread(target=produce_batches, daemon=True)
+        producer.start()
+
         # tqdm progress bar
         pbar = tqdm(total=estimated_rows, unit="rows", ncols=80)
 
         while True:
-            batch = list(islice(reader, batch_size))
-            if not batch:
+            item = batch_queue.get()
+            if item is None:
                 break
+            if isinstance(item, Exception):
+                raise item
+            data_to_insert, num_rows = item
 
-            data_to_insert, next_rowid, last_parent_rowid = process_batch(
-                batch, next_rowid, last_parent_rowid
-            )
-
-            cur.executemany(
-                f"INSERT INTO {table_name} ({', '.join(insert_columns)}) VALUES ({placeholders})",
-                data_to_insert,
-            )
-
-            total_inserted += len(batch)
-            pbar.update(len(batch))
+            cur.executemany(insert_sql, data_to_insert)
 
-            # break # debug: stop after first batch
+            total_inserted += num_rows
+            pbar.update(num_rows)
 
-        conn.commit()
         pbar.close()
-        print(f"done {sqlite_path.name} with {total_inserted:_} rows")
+        producer.join()
+
+    # The filter of get_random_address_pairs.py as a view
+    # so ad-hoc queries do not have to repeat the WHERE clause
+    cur.execute(
+        f"CREATE VIEW {ELIGIBLE_VIEW_NAME} AS "
+        f"SELECT * FROM {table_name} "
+        f"WHERE {DEFAULT_WHERE_CLAUSE}"
+    )
+
+    # Materialize the rows used by get_random_address_pairs.py
+    # into a slim table with gapless ids
+    # so random sampling does not scan the full table
+    # rows are sorted by zipcode prefix
+    # so each prefix bucket is a contiguous range of ids
+    print(f"creating table {ELIGIBLE_TABLE_NAME}")
+    eligible_columns = ", ".join(ELIGIBLE_COLUMNS)
+    cur.execute(
+        f"CREATE TABLE {ELIGIBLE_TABLE_NAME} (\n"
+        "  id INTEGER PRIMARY KEY,\n"
+        +
+        ",\n".join(f"  {col} TEXT" for col in ELIGIBLE_COLUMNS)
+        +
+        "\n)"
+    )
+    cur.execute(
+        f"INSERT INTO {ELIGIBLE_TABLE_NAME} ({eligible_columns}) "
+        f"SELECT {eligible_columns} FROM {ELIGIBLE_VIEW_NAME} "
+        "ORDER BY substr(zipcode, 1, 2), id"
+    )
+    cur.execute(
+        f"CREATE INDEX {ELIGIBLE_TABLE_NAME}_zip "
+        f"ON {ELIGIBLE_TABLE_NAME} (substr(zipcode, 1, 2), id)"
+    )
+
+    conn.commit()
+    print(f"done {sqlite_path.name} with {total_inserted:_} rows")
+
+    if sqlite_cli:
+        cur.execute("DETACH DATABASE staging")
+        os.unlink(staging_path)
 
     conn.close()
 
@@ -163,6 +345,6 @@ if __name__ == "__main__":
     csv_file = "telefonbuch.csv"
     sqlite_file = "telefonbuch.db"
     table = "telefonbuch"
-    batch_size = 10_000
+    block_size = 16 << 20 # 16 MiB
 
-    csv_to_sqlite(csv_file, sqlite_file, table, batch_size)
+    csv_to_sqlite(csv_file, sqlite_file, table, block_size)
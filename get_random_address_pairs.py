@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import sqlite3
-from collections import defaultdict
 import random
 
 def format_address(row, delimiter="\n"):
@@ -14,38 +13,50 @@ def format_address(row, delimiter="\n"):
         return lines
     return delimiter.join(lines)
 
-def fetch_random_entries(conn, limit, TABLE_NAME, WHERE_CLAUSE):
-    """Fetch a batch of random entries from the database."""
-    query = f"""
-        SELECT * FROM {TABLE_NAME}
-        WHERE {WHERE_CLAUSE}
-        ORDER BY RANDOM()
-        LIMIT ?
-    """
-    return conn.execute(query, (limit,)).fetchall()
-
-def generate_pairs(entries, ZIP_COLUMN):
+def get_prefix_id_range(conn, prefix, TABLE_NAME, ZIP_COLUMN):
+    """Get the first and last id of rows with this zipcode prefix."""
+    # csv2sqlite.py inserts the rows sorted by zipcode prefix
+    # so each prefix has a contiguous range of ids
+    # MIN and MAX are separate queries
+    # so each one is a single lookup in the (prefix, id) index
+    where = f"substr({ZIP_COLUMN}, 1, 2) = ?"
+    first_id = conn.execute(f"SELECT MIN(id) FROM {TABLE_NAME} WHERE {where}", (prefix,)).fetchone()[0]
+    last_id = conn.execute(f"SELECT MAX(id) FROM {TABLE_NAME} WHERE {where}", (prefix,)).fetchone()[0]
+    return first_id, last_id
+
+def generate_pairs(conn, PAIR_COUNT, TABLE_NAME, ZIP_COLUMN):
     """
     Generate pairs of addresses that share the same zipcode prefix.
     """
-    prefix_map = defaultdict(list)
-    for entry in entries:
-        prefix = entry[ZIP_COLUMN][:2]
-        prefix_map[prefix].append(entry)
+    prefixes = [f"{i:02d}" for i in range(0, 100)]
+    id_ranges = dict()
 
     pairs = []
-    for group in prefix_map.values():
-        # take pairs sequentially
-        while len(group) >= 2:
-            pair = (group.pop(0), group.pop(0))
-            pairs.append(pair)
+    while len(pairs) < PAIR_COUNT:
+        # take one pair from each prefix bucket, in random order
+        num_pairs = len(pairs)
+        random.shuffle(prefixes)
+        for prefix in prefixes:
+            if prefix not in id_ranges:
+                id_ranges[prefix] = get_prefix_id_range(conn, prefix, TABLE_NAME, ZIP_COLUMN)
+            first_id, last_id = id_ranges[prefix]
+            if first_id is None or first_id == last_id:
+                continue # less than 2 rows
+            ids = random.sample(range(first_id, last_id + 1), 2)
+            rows = conn.execute(f"SELECT * FROM {TABLE_NAME} WHERE id IN (?, ?)", ids).fetchall()
+            random.shuffle(rows)
+            pairs.append(tuple(rows))
+            if len(pairs) >= PAIR_COUNT:
+                break
+        if len(pairs) == num_pairs:
+            break # no bucket has 2 rows
     return pairs
 
 DEFAULT_WHERE_CLAUSE = " AND ".join([
     # exclude child entries
     "recordtype_int IN (0, 1)",
     # exclude commercial entries
-    "commercial = FALSE",
+    "commercial = 0",
     "firstname0 != ''",
     # exclude abbreviated firstnames like "A."
     "LENGTH(firstname0) > 2",
@@ -56,32 +67,35 @@ DEFAULT_WHERE_CLAUSE = " AND ".join([
     "city != ''",
 ])
 
+# all rows matching DEFAULT_WHERE_CLAUSE
+# created by csv2sqlite.py
+ELIGIBLE_VIEW_NAME = "eligible_v"
+
+# slim copy of ELIGIBLE_VIEW_NAME
+# created by csv2sqlite.py
+ELIGIBLE_TABLE_NAME = "eligible"
+
+ELIGIBLE_COLUMNS = [
+    "firstname0",
+    "name0",
+    "street",
+    "housenumber",
+    "zipcode",
+    "city",
+]
+
 def get_random_address_pairs(
         DB_PATH = "telefonbuch.db",
-        TABLE_NAME = "telefonbuch",
+        TABLE_NAME = ELIGIBLE_TABLE_NAME,
         ZIP_COLUMN = "zipcode",
-        SAMPLE_SIZE = 1000,   # number of random entries to fetch per batch
         PAIR_COUNT = 100,     # number of pairs to generate
-        WHERE_CLAUSE = DEFAULT_WHERE_CLAUSE,
     ):
 
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
 
-    all_pairs = []
-
-    # keep fetching random samples until we have enough pairs
-    while len(all_pairs) < PAIR_COUNT:
-        entries = fetch_random_entries(conn, SAMPLE_SIZE, TABLE_NAME, WHERE_CLAUSE)
-        if not entries:
-            break  # no more data
-
-        pairs = generate_pairs(entries, ZIP_COLUMN)
-        random.shuffle(pairs)
-        all_pairs.extend(pairs)
-
-    # trim to the desired number of pairs
-    all_pairs = all_pairs[:PAIR_COUNT]
+    all_pairs = generate_pairs(conn, PAIR_COUNT, TABLE_NAME, ZIP_COLUMN)
+    random.shuffle(all_pairs)
 
     conn.close()
 
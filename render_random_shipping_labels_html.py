@@ -20,8 +20,8 @@ import get_random_address_pairs
 num_labels_per_page_width = 2
 num_labels_per_page_height = 5
 
-# output_html = io.StringIO()
-output_html = sys.stdout
+# buffer the whole document and write it to stdout once at the end
+output_html = io.StringIO()
 
 output_html.write("""\
 <!DOCTYPE html>
@@ -111,49 +111,58 @@ output_html.write("""\
 <body>
 """)
 
-num_labels_per_page_width = 2
-num_labels_per_page_height = 5
-
-next_label_x = 0
-next_label_y = 0
-
-def render_address_pair(buf, address_pair):
-    global next_label_x
-    global next_label_y
-    buf.write(f"\n<!-- label x={next_label_x} y={next_label_y} -->\n")
-    if next_label_x == 0 and next_label_y == 0:
-        buf.write("<div class=page>")
-        buf.write("<div class=page-height-spacer></div>")
-        buf.write("<table>")
-    if next_label_x == 0:
-        buf.write("<tr>")
-    buf.write("<td>")
-    buf.write("<div class=label><div class=label-content>\n")
-    buf.write("<div class=from><div class=from-content>")
-    # no. too many line overflows
-    # buf.write(get_random_address_pairs.format_address(address_pair[0], delimiter=", "))
-    buf.write(get_random_address_pairs.format_address(address_pair[0], delimiter="<br>"))
-    buf.write("</div></div>\n") # from
-    buf.write("<div class=to><div class=to-content>")
-    buf.write(get_random_address_pairs.format_address(address_pair[1], delimiter="<br>"))
-    buf.write("</div></div>\n") # to
-    buf.write("</div></div>\n") # label
-    buf.write("</td>")
-    if next_label_x == num_labels_per_page_width - 1:
-        buf.write("</tr>")
-        next_label_x = 0
-        next_label_y += 1
-    else:
-        next_label_x += 1
-    if next_label_y == num_labels_per_page_height:
-        buf.write("</table>")
-        buf.write("<div class=page-height-spacer></div>")
-        buf.write("</div>\n")
-        next_label_y = 0
+LABEL_TPL = """\
+<td><div class=label><div class=label-content>
+<div class=from><div class=from-content>{from_html}</div></div>
+<div class=to><div class=to-content>{to_html}</div></div>
+</div></div>
+</td>"""
+
+PAGE_START = "<div class=page><div class=page-height-spacer></div><table>"
+PAGE_END = "</table><div class=page-height-spacer></div></div>\n"
+
+num_labels_per_page = num_labels_per_page_width * num_labels_per_page_height
+
+def render_address_pair(label_idx, address_pair):
+    """Render one label. The position on the page follows from label_idx."""
+    y, x = divmod(label_idx % num_labels_per_page, num_labels_per_page_width)
+    parts = [f"\n<!-- label x={x} y={y} -->\n"]
+    if x == 0 and y == 0:
+        parts.append(PAGE_START)
+    if x == 0:
+        parts.append("<tr>")
+    parts.append(LABEL_TPL.format_map(dict(
+        # no. too many line overflows
+        # from_html=get_random_address_pairs.format_address(address_pair[0], delimiter=", "),
+        from_html=get_random_address_pairs.format_address(address_pair[0], delimiter="<br>"),
+        to_html=get_random_address_pairs.format_address(address_pair[1], delimiter="<br>"),
+    )))
+    if x == num_labels_per_page_width - 1:
+        parts.append("</tr>")
+        if y == num_labels_per_page_height - 1:
+            parts.append(PAGE_END)
+    return "".join(parts)
+
+def render_end(num_labels):
+    """Close the last row and page if they are not full."""
+    x = num_labels % num_labels_per_page_width
+    parts = []
+    if x != 0:
+        parts.append("</tr>")
+    if num_labels % num_labels_per_page != 0:
+        parts.append(PAGE_END)
+    parts.append("</body>\n</html>\n")
+    return "".join(parts)
 
 kwargs = dict(
     PAIR_COUNT = 100,
 )
 
-for address_pair in get_random_address_pairs.get_random_address_pairs(**kwargs):
-    render_address_pair(output_html, address_pair)
+num_labels = 0
+for label_idx, address_pair in enumerate(get_random_address_pairs.get_random_address_pairs(**kwargs)):
+    output_html.write(render_address_pair(label_idx, address_pair))
+    num_labels += 1
+output_html.write(render_end(num_labels))
+
+sys.stdout.reconfigure(write_through=False)
+sys.stdout.write(output_html.getvalue())
@@ -11,6 +11,8 @@ pkgs.mkShell {
       aiohttp
       aiohttp-retry
       lxml
+      numpy
+      pyarrow
       tqdm
     ]))
   ];
@@ -4,6 +4,7 @@
 import os
 import sys
 import math
+import mmap
 
 
 def split_file(input_file, chunk_size):
@@ -14,27 +15,39 @@ def split_file(input_file, chunk_size):
     total_chunks = math.ceil(file_size / chunk_size)
     num_digits = len(str(total_chunks))  # number of digits for zero-padding
 
-    chunk_num = 1
-    bytes_written = 0
-    output_file = f"{base_path}.part{str(chunk_num).zfill(num_digits)}{file_ext}"
-    out_f = open(output_file, 'wb')
-    print(f"writing {output_file}")
-
-    with open(input_file, 'rb') as f:
-        for line in f:
-            # If adding this line exceeds the chunk size, start a new chunk
-            if bytes_written + len(line) > chunk_size:
-                out_f.close()
-                chunk_num += 1
-                bytes_written = 0
-                output_file = f"{base_path}.part{str(chunk_num).zfill(num_digits)}{file_ext}"
-                out_f = open(output_file, 'wb')
-                print(f"writing {output_file}")
-
-            out_f.write(line)
-            bytes_written += len(line)
-
-    out_f.close()
+    chunk_num = 0
+
+    def write_chunk(data):
+        nonlocal chunk_num
+        chunk_num += 1
+        output_file = f"{base_path}.part{str(chunk_num).zfill(num_digits)}{file_ext}"
+        print(f"writing {output_file}")
+        with open(output_file, 'wb') as out_f:
+            out_f.write(data)
+
+    if file_size == 0:
+        # mmap cannot map an empty file
+        write_chunk(b"")
+        return
+
+    # map the whole file and cut it at the last newline before each chunk_size boundary
+    # rfind and find run in C over the mapped pages, so there is no per-line Python loop
+    with open(input_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        with memoryview(mm) as view:
+            pos = 0
+            while pos < file_size:
+                end = pos + chunk_size
+                if end >= file_size:
+                    end = file_size
+                else:
+                    cut = mm.rfind(b"\n", pos, end) + 1
+                    if cut == 0:
+                        # the line is longer than chunk_size
+                        # write it to its own chunk
+                        cut = mm.find(b"\n", end) + 1 or file_size
+                    end = cut
+                write_chunk(view[pos:end])
+                pos = end
 
 
 if __name__ == "__main__":
@@ -2,9 +2,15 @@
 
 import sqlite3
 import csv
+import io
+import re
 import tempfile
 import os
 import sys
+import collections
+import functools
+import heapq
+import multiprocessing
 
 from tqdm import tqdm
 
@@ -44,51 +50,57 @@ for col, _type in telefonbuch_columns.items():
         bool_columns.add(col)
 
 
+newline_regex = re.compile(r"\r\n|\r|\n")
+
+
 def escape_newlines(value: str) -> str:
     """Escape newlines with \\n for CSV stability."""
     if isinstance(value, str):
-        return value.replace("\r\n", "\\n").replace("\r", "\\n").replace("\n", "\\n")
+        return newline_regex.sub(r"\\n", value)
     return value
 
 
-def bool_to_int(key, value):
-    """Convert booleans to integers."""
-    if key in bool_columns:
-        return 1 if value[0] == "t" else None
-        return 1 if value[0] == "t" else 0
-    return value
-    # if isinstance(value, bool):
-    #     return int(value)
-    # if value in ("true", "True", "TRUE"):
-    #     return 1
-    # if value in ("false", "False", "FALSE"):
-    #     return 0
-    # return value
-
-
-def serialize_payload(row, payload_cols):
-    """Serialize payload columns into a single deterministic CSV string."""
-    parts = []
-    for c in payload_cols:
-        v = bool_to_int(c, escape_newlines(row[c]))
-        if v is None:
-            s = ""
+def payload_field(value):
+    """Convert one payload value to a string. Slow path of payload_fields."""
+    v = escape_newlines(value)
+    if v is None:
+        return ""
+    s = str(v)
+    if s == "0":
+        return "" # compress 0 to None
+    return s
+
+
+@functools.lru_cache
+def make_payload_fields(payload_cols, payload_idx):
+    """Generate a function which converts the payload columns of one row tuple to strings.
+
+    The per-column branches are resolved once here, not once per field and row.
+    """
+    lines = []
+    for c, i in zip(payload_cols, payload_idx):
+        if c in bool_columns:
+            # 'true' -> 1, 'false' -> None
+            expr = f'"1" if (v := row[{i}]) and v[0] == "t" else ""'
         else:
-            s = str(v)
-        if s == "0":
-            s = "" # compress 0 to None
-        # quote only when necessary
-        if ";" in s or "\n" in s or '"' in s:
-            s = '"' + s.replace('"', '""') + '"'
-        parts.append(s)
-    return ";".join(parts)
-
-
-def deserialize_payload(payload_csv):
-    """Split payload CSV line back into list of strings."""
-    # use csv.reader to properly handle quotes
-    reader = csv.reader([payload_csv], delimiter=";")
-    return next(reader)
+            # fast path: a string without newlines is used as is
+            expr = f'v if (v := row[{i}]).__class__ is str and v != "0" and "\\n" not in v and "\\r" not in v else payload_field(v)'
+        lines.append(f"        {expr}, # {c}\n")
+    source = "def payload_fields(row):\n    return [\n" + "".join(lines) + "    ]\n"
+    namespace = {"payload_field": payload_field}
+    exec(compile(source, "<payload_fields>", "exec"), namespace)
+    return namespace["payload_fields"]
+
+
+def serialize_payloads(rows, payload_cols, payload_idx):
+    """Serialize payload columns of many rows into deterministic CSV strings."""
+    # csv.writer does the quoting in C
+    # newlines are escaped, so every row is one line
+    buf = io.StringIO()
+    writer = csv.writer(buf, delimiter=";", quoting=csv.QUOTE_MINIMAL, lineterminator="\n")
+    payload_fields = make_payload_fields(tuple(payload_cols), tuple(payload_idx))
+    writer.writerows(map(payload_fields, rows))
+    return buf.getvalue().split("\n")[:-1]
 
 
 def recordtype_to_int(value: str) -> int:
@@ -101,32 +113,14 @@ def recordtype_to_int(value: str) -> int:
     return 0
 
 
-def convert_sqlite_to_csv(source_db, source_table, output_csv):
-    # tmp_fd, tmp_path = tempfile.mkstemp(suffix=".sqlite")
-    # os.close(tmp_fd)
-    tmp_path = "sqlite2csv.temp.db"
-    print(f"[info] temporary DB: {tmp_path}")
-
-    if os.path.exists(tmp_path):
-        os.unlink(tmp_path)
-
-    if os.path.exists(output_csv):
-        os.unlink(output_csv)
-
-    src = sqlite3.connect(source_db)
-    src.row_factory = sqlite3.Row
-    tmp = sqlite3.connect(tmp_path)
-    tmp.row_factory = sqlite3.Row
-
-    s_cur = src.cursor()
-    t_cur = tmp.cursor()
-
+def get_payload_cols(s_cur, source_table):
+    """Get all columns and the payload columns of the source table."""
     # get columns from source table
     s_cur.execute(f"PRAGMA table_info({source_table})")
     cols_info = s_cur.fetchall()
     if not cols_info:
         raise SystemExit(f"Table {source_table} not found or has no columns.")
-    all_cols = [r["name"] for r in cols_info]
+    all_cols = [r[1] for r in cols_info] # name
 
     # determine payload columns (exclude meta + ignored)
     ignored = {"query_name", "query_offset", "query_child_num", "recordtype"}
@@ -135,229 +129,50 @@ def convert_sqlite_to_csv(source_db, source_table, output_csv):
 
     print(f"[info] payload columns ({len(payload_cols)}): {payload_cols}")
 
-    # count rows for progress
-    s_cur.execute(f"SELECT COUNT(1) FROM {source_table}")
-    num_source_rows = s_cur.fetchone()[0]
-    print(f"[info] source rows: {num_source_rows:,}")
-
-    # ------------------------
-    # Stage 1: copy rows to temp with serialized payload and numeric recordtype
-    # ------------------------
-    t_cur.execute(
-        "CREATE TABLE temp (recordtype INTEGER, id INTEGER, parent_id INTEGER, payload_csv TEXT)"
+    return all_cols, payload_cols
+
+
+def get_column_indices(all_cols, payload_cols):
+    """Map column names to indices in the source row tuples."""
+    col_idx = {name: i for i, name in enumerate(all_cols)}
+    payload_idx = [col_idx[c] for c in payload_cols]
+    recordtype_idx = col_idx.get("recordtype")
+    return payload_idx, col_idx["id"], col_idx["parent_id"], recordtype_idx
+
+
+def convert_temp_rows(rows, payload_cols, payload_idx, id_idx, parent_id_idx, recordtype_idx):
+    """Convert a chunk of source rows to temp rows. Runs in a worker process."""
+    payloads = serialize_payloads(rows, payload_cols, payload_idx)
+    # rows per recordtype
+    counts = [0, 0, 0]
+    temp_rows = []
+    for row, payload_csv in zip(rows, payloads):
+        rt = recordtype_to_int(row[recordtype_idx]) if recordtype_idx is not None else 0
+        counts[rt] += 1
+        temp_rows.append((rt, row[id_idx], row[parent_id_idx], payload_csv))
+    return temp_rows, counts
+
+
+def sql_payload_field(col):
+    """SQL expression with the same result as payload_fields for one column."""
+    if col in bool_columns:
+        return f"CASE WHEN substr({col}, 1, 1) = 't' THEN '1' ELSE '' END"
+    text = f"CAST({col} AS TEXT)"
+    escaped = f"replace(replace(replace({text}, char(13, 10), '\\n'), char(13), '\\n'), char(10), '\\n')"
+    # quote only when necessary, like csv.QUOTE_MINIMAL
+    return (
+        f"CASE WHEN {col} IS NULL OR {text} = '0' THEN '' "
+        f"WHEN instr({text}, ';') OR instr({text}, '\"') THEN '\"' || replace({escaped}, '\"', '\"\"') || '\"' "
+        f"ELSE {escaped} END"
     )
 
-    # s_cur.execute(f"SELECT * FROM {source_table}")
-    s_cur.execute(f"SELECT * FROM {source_table} LIMIT 100000") # debug
-
-    batch = []
-    batch_size = 5000
-    inserted = 0
-    with tqdm(total=num_source_rows, unit="rows", ncols=80, desc="Stage 1 - copy") as pbar:
-        for row in s_cur:
-            rt = recordtype_to_int(row["recordtype"]) if "recordtype" in row.keys() else 0
-            payload_csv = serialize_payload(row, payload_cols)
-            batch.append((rt, row["id"], row["parent_id"], payload_csv))
-            if len(batch) >= batch_size:
-                t_cur.executemany("INSERT INTO temp VALUES (?,?,?,?)", batch)
-                tmp.commit()
-                inserted += len(batch)
-                pbar.update(len(batch))
-                batch.clear()
-        if batch:
-            t_cur.executemany("INSERT INTO temp VALUES (?,?,?,?)", batch)
-            tmp.commit()
-            inserted += len(batch)
-            pbar.update(len(batch))
-            batch.clear()
-
-    print(f"[info] inserted into temp: {inserted:,}")
-
-    print("creating index idx_temp_parent_id")
-    t_cur.execute("CREATE INDEX IF NOT EXISTS idx_temp_parent_id ON temp(parent_id)")
-    tmp.commit()
-
-    # slow?
-    print("creating index idx_temp_payload")
-    t_cur.execute("CREATE INDEX IF NOT EXISTS idx_temp_payload ON temp(payload_csv)")
-    tmp.commit()
-
-    # sanity counts
-    t_cur.execute("SELECT COUNT(1) FROM temp WHERE recordtype = 1")
-    total_parents_raw = t_cur.fetchone()[0]
-    t_cur.execute("SELECT COUNT(1) FROM temp WHERE recordtype = 2")
-    total_children_raw = t_cur.fetchone()[0]
-    t_cur.execute("SELECT COUNT(1) FROM temp WHERE recordtype = 0")
-    total_singles_raw = t_cur.fetchone()[0]
-    print(
-        f"[info] raw counts - parents: {total_parents_raw:,}, children: {total_children_raw:,}, singles: {total_singles_raw:,}"
-    )
 
-    # ------------------------
-    # Stage 2: Build parent_map (id -> parent_payload) from ALL parent rows
-    # ------------------------
-    print("[info] building parent_map (id -> parent_payload) ...")
-    t_cur.execute("CREATE TABLE parent_map (id INTEGER PRIMARY KEY, parent_payload TEXT)")
-    # Insert in batches to allow progress
-    t_cur.execute("SELECT COUNT(1) FROM temp WHERE recordtype = 1")
-    parent_rows_count = t_cur.fetchone()[0]
-    with tqdm(total=parent_rows_count, unit="rows", ncols=80, desc="Stage 2 - parent_map") as pbar:
-        cur = t_cur.execute("SELECT id, payload_csv FROM temp WHERE recordtype = 1")
-        batch = []
-        bs = 2000
-        processed = 0
-        for r in cur:
-            batch.append((r["id"], r["payload_csv"]))
-            if len(batch) >= bs:
-                t_cur.executemany("INSERT INTO parent_map (id, parent_payload) VALUES (?,?)", batch)
-                tmp.commit()
-                processed += len(batch)
-                pbar.update(len(batch))
-                batch.clear()
-        if batch:
-            t_cur.executemany("INSERT INTO parent_map (id, parent_payload) VALUES (?,?)", batch)
-            tmp.commit()
-            processed += len(batch)
-            pbar.update(len(batch))
-            batch.clear()
-    t_cur.execute("CREATE INDEX IF NOT EXISTS idx_parent_map_payload ON parent_map(parent_payload)")
-    tmp.commit()
-    t_cur.execute("SELECT COUNT(1) FROM parent_map")
-    parent_map_count = t_cur.fetchone()[0]
-    print(f"[info] parent_map entries: {parent_map_count:,}")
+def sql_payload_expr(payload_cols):
+    """SQL expression with the same result as serialize_payloads for one row."""
+    return "\n  || ';' || ".join(map(sql_payload_field, payload_cols))
 
-    # ------------------------
-    # Stage 3: Deduplicate parents by payload_csv (unique parent payloads)
-    # ------------------------
-    print("[info] deduplicating parents by payload...")
-    # parents: one unique row per parent_payload
-    t_cur.execute(
-        """
-        CREATE TABLE parents AS
-        SELECT MIN(id) AS id, parent_payload AS payload_csv
-        FROM parent_map
-        GROUP BY parent_payload
-        ORDER BY parent_payload
-        """
-    )
-    tmp.commit()
-    t_cur.execute("CREATE INDEX IF NOT EXISTS idx_parents_payload ON parents(payload_csv)")
-    tmp.commit()
-    t_cur.execute("SELECT COUNT(1) FROM parents")
-    unique_parents = t_cur.fetchone()[0]
-    print(f"[info] unique parent payloads: {unique_parents:,}")
 
-    # ------------------------
-    # Stage 4: Deduplicate children within their parent's payload
-    #   Join every child row to parent_map to get parent's payload,
-    #   Group by (parent_payload, child_payload) to deduplicate.
-    # ------------------------
-    print("[info] deduplicating children (group by parent_payload + child_payload) ...")
-    # count raw child rows for progress
-    t_cur.execute("SELECT COUNT(1) FROM temp WHERE recordtype = 2")
-    children_raw_count = t_cur.fetchone()[0]
-
-    # create children table
-    t_cur.execute(
-        """
-        CREATE TABLE children AS
-        SELECT MIN(t.id) AS id,
-               pm.parent_payload AS parent_payload,
-               t.payload_csv AS payload_csv
-        FROM temp t
-        JOIN parent_map pm ON t.parent_id = pm.id
-        WHERE t.recordtype = 2
-        GROUP BY pm.parent_payload, t.payload_csv
-        ORDER BY pm.parent_payload, t.payload_csv
-        """
-    )
-    tmp.commit()
-    t_cur.execute("CREATE INDEX IF NOT EXISTS idx_children_parent_payload ON children(parent_payload)")
-    tmp.commit()
-    t_cur.execute("SELECT COUNT(1) FROM children")
-    unique_children = t_cur.fetchone()[0]
-    print(
-        f"[info] children: raw={children_raw_count:,}, unique_by_parent_payload={unique_children:,}"
-    )
-
-    # ------------------------
-    # Stage 5: Deduplicate singles (recordtype == 0)
-    # ------------------------
-    print("[info] deduplicating singles ...")
-    t_cur.execute(
-        """
-        CREATE TABLE singles AS
-        SELECT MIN(id) AS id, payload_csv
-        FROM temp
-        WHERE recordtype = 0
-        GROUP BY payload_csv
-        ORDER BY payload_csv
-        """
-    )
-    tmp.commit()
-    t_cur.execute("SELECT COUNT(1) FROM singles")
-    unique_singles = t_cur.fetchone()[0]
-    print(f"[info] unique singles: {unique_singles:,}")
-
-    # ------------------------
-    # Stage 6: Write final CSV
-    # ------------------------
-    print("[info] writing CSV ...")
-    # We'll calculate total for progress bar as total output rows estimate
-    t_cur.execute("SELECT COUNT(1) FROM parents")
-    cnt_parents_out = t_cur.fetchone()[0]
-    t_cur.execute("SELECT COUNT(1) FROM children")
-    cnt_children_out = t_cur.fetchone()[0]
-    t_cur.execute("SELECT COUNT(1) FROM singles")
-    cnt_singles_out = t_cur.fetchone()[0]
-    total_out_rows = cnt_parents_out + cnt_children_out + cnt_singles_out
-    print(
-        f"[info] output rows estimate: parents={cnt_parents_out:,}, children={cnt_children_out:,}, singles={cnt_singles_out:,} -> total={total_out_rows:,}"
-    )
-
-    with open(output_csv, "w", newline="", encoding="utf-8") as outf:
-        writer = csv.writer(outf, delimiter=";", quoting=csv.QUOTE_MINIMAL)
-        # header: type + payload cols
-        writer.writerow(["recordtype_int"] + payload_cols)
-
-        with tqdm(total=total_out_rows, unit="rows", ncols=80, desc="Stage 6 - write CSV") as pbar:
-            # parents in lexicographic order of payload
-            for parent in t_cur.execute("SELECT payload_csv FROM parents ORDER BY payload_csv"):
-                parent_payload = parent["payload_csv"]
-                writer.writerow([1] + deserialize_payload(parent_payload))
-                pbar.update(1)
-
-                # children that belong to this parent_payload
-                for child in t_cur.execute(
-                    "SELECT payload_csv FROM children WHERE parent_payload = ? ORDER BY payload_csv",
-                    (parent_payload,),
-                ):
-                    writer.writerow([2] + deserialize_payload(child["payload_csv"]))
-                    pbar.update(1)
-
-            # singles
-            for single in t_cur.execute("SELECT payload_csv FROM singles ORDER BY payload_csv"):
-                writer.writerow([0] + deserialize_payload(single["payload_csv"]))
-                pbar.update(1)
-
-    print(f"[info] CSV written to: {output_csv}")
-
-    src.close()
-    tmp.close()
-
-    # cleanup
-    keep_temp_db = False
-    if keep_temp_db:
-        print(f"[info] temporary DB kept at: {tmp_path}")
-    else:
-        try:
-            os.remove(tmp_path)
-            print("[info] temporary DB removed")
-        except Exception as e:
-            print(f"[warning] failed to remove temp DB: {e}")
-
-
-def convert_sqlite_to_csv(source_db, source_table, output_csv, keep_temp_db=True):
+def convert_sqlite_to_csv(source_db, source_table, output_csv, keep_temp_db=True, num_workers=os.cpu_count(), sql_payload=True):
     # tmp_fd, tmp_path = tempfile.mkstemp(suffix=".sqlite")
     # os.close(tmp_fd)
     tmp_path = "sqlite2csv.temp.db"
@@ -369,36 +184,43 @@ def convert_sqlite_to_csv(source_db, source_table, output_csv, keep_temp_db=True
     if os.path.exists(output_csv):
         os.unlink(output_csv)
 
+    # plain tuples, no sqlite3.Row name lookups per column
     src = sqlite3.connect(source_db)
-    src.row_factory = sqlite3.Row
-    tmp = sqlite3.connect(tmp_path)
+    # autocommit mode, transactions are managed explicitly
+    tmp = sqlite3.connect(tmp_path, isolation_level=None)
     tmp.row_factory = sqlite3.Row
 
+    # the temp DB is scratch space, so durability does not matter
+    # page_size must be set before WAL mode and before the first table is created
+    # with 32 KiB pages, most payload rows fit on one page without overflow pages
+    tmp.execute("PRAGMA page_size = 32768")
+    tmp.execute("PRAGMA journal_mode = WAL")
+    tmp.execute("PRAGMA synchronous = OFF")
+    tmp.execute("PRAGMA temp_store = MEMORY")
+    tmp.execute("PRAGMA cache_size = -1048576") # 1 GiB
+    tmp.execute("PRAGMA mmap_size = 30000000000")
+
     s_cur = src.cursor()
     t_cur = tmp.cursor()
 
-    # get columns from source table
-    s_cur.execute(f"PRAGMA table_info({source_table})")
-    cols_info = s_cur.fetchall()
-    if not cols_info:
-        raise SystemExit(f"Table {source_table} not found or has no columns.")
-    all_cols = [r["name"] for r in cols_info]
-
-    # determine payload columns (exclude meta + ignored)
-    ignored = {"query_name", "query_offset", "query_child_num", "recordtype"}
-    meta = {"id", "parent_id"}
-    payload_cols = [c for c in all_cols if c not in ignored and c not in meta]
-
-    print(f"[info] payload columns ({len(payload_cols)}): {payload_cols}")
+    all_cols, payload_cols = get_payload_cols(s_cur, source_table)
+    payload_idx, id_idx, parent_id_idx, recordtype_idx = get_column_indices(all_cols, payload_cols)
 
     # if not os.path.exists(tmp_path) or os.path.getsize(tmp_path) == 0:
 
+    if sql_payload:
+        # ATTACH is not allowed inside a transaction
+        t_cur.execute("ATTACH DATABASE ? AS src", (source_db,))
+
     if 1:
         # count rows for progress
         s_cur.execute(f"SELECT COUNT(*) FROM {source_table}")
         num_source_rows = s_cur.fetchone()[0]
         print(f"[info] source rows: {num_source_rows:,}")
 
+        # one transaction for Stages 1 to 6, instead of one commit per batch
+        t_cur.execute("BEGIN")
+
         # ------------------------
         # Stage 1: copy rows to temp with serialized payload and numeric recordtype
         # ------------------------
@@ -406,127 +228,135 @@ def convert_sqlite_to_csv(source_db, source_table, output_csv, keep_temp_db=True
             "CREATE TABLE temp (recordtype INTEGER, id INTEGER, parent_id INTEGER, payload_csv TEXT)"
         )
 
-        sql = f"SELECT * FROM {source_table}"
-        if 0:
-            # debug
-            num_source_rows = 1_000_000
-            sql += f" LIMIT {num_source_rows}"
-        s_cur.execute(sql)
-
-        batch = []
-        batch_size = 5000
-        inserted = 0
-        with tqdm(total=num_source_rows, unit="rows", ncols=80, desc="Stage 1 - copy") as pbar:
-            for row in s_cur:
-                rt = recordtype_to_int(row["recordtype"]) if "recordtype" in row.keys() else 0
-                payload_csv = serialize_payload(row, payload_cols)
-                batch.append((rt, row["id"], row["parent_id"], payload_csv))
-                if len(batch) >= batch_size:
-                    t_cur.executemany("INSERT INTO temp VALUES (?,?,?,?)", batch)
-                    tmp.commit()
-                    inserted += len(batch)
-                    pbar.update(len(batch))
-                    batch.clear()
-            if batch:
-                t_cur.executemany("INSERT INTO temp VALUES (?,?,?,?)", batch)
-                tmp.commit()
-                inserted += len(batch)
-                pbar.update(len(batch))
-                batch.clear()
+        if sql_payload:
+            # copy and serialize in one SQL statement
+            # no row crosses the boundary between SQLite and Python
+            if recordtype_idx is not None:
+                recordtype_expr = "CASE substr(recordtype, 1, 1) WHEN 'p' THEN 1 WHEN 'c' THEN 2 ELSE 0 END"
+            else:
+                recordtype_expr = "0"
+            print("[info] Stage 1 - copy in SQL ...")
+            t_cur.execute(
+                "INSERT INTO temp (recordtype, id, parent_id, payload_csv)\n"
+                f"SELECT {recordtype_expr}, id, parent_id,\n  {sql_payload_expr(payload_cols)}\n"
+                f"FROM src.{source_table}"
+            )
+            inserted = t_cur.rowcount
+            # rows per recordtype, in one scan
+            raw_counts = [0, 0, 0]
+            for rt, count in tmp.execute("SELECT recordtype, COUNT(*) FROM temp GROUP BY recordtype"):
+                raw_counts[rt] = count
+
+        else:
+            sql = f"SELECT * FROM {source_table}"
+            if 0:
+                # debug
+                num_source_rows = 1_000_000
+                sql += f" LIMIT {num_source_rows}"
+            s_cur.execute(sql)
+
+            # fetch chunks of rows, serialize them in a pool of worker processes
+            # and feed the results to one executemany as a generator
+            batch_size = 50_000
+            # rows per recordtype, counted here instead of COUNT(*) queries on temp
+            raw_counts = [0, 0, 0]
+
+            convert = functools.partial(
+                convert_temp_rows,
+                payload_cols=payload_cols,
+                payload_idx=payload_idx,
+                id_idx=id_idx,
+                parent_id_idx=parent_id_idx,
+                recordtype_idx=recordtype_idx,
+            )
+
+            def temp_rows(pool):
+                # the source cursor is only used in this thread
+                # and at most 2 chunks per worker are in flight, in source order
+                pending = collections.deque()
+                while True:
+                    while len(pending) < 2 * num_workers:
+                        rows = s_cur.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        pending.append(pool.apply_async(convert, (rows,)))
+                    if not pending:
+                        return
+                    chunk_rows, counts = pending.popleft().get()
+                    for rt, count in enumerate(counts):
+                        raw_counts[rt] += count
+                    yield from chunk_rows
+                    pbar.update(len(chunk_rows))
+
+            with multiprocessing.Pool(num_workers) as pool:
+                with tqdm(total=num_source_rows, unit="rows", ncols=80, desc="Stage 1 - copy") as pbar:
+                    t_cur.executemany("INSERT INTO temp VALUES (?,?,?,?)", temp_rows(pool))
+            inserted = t_cur.rowcount
 
         print(f"[info] inserted into temp: {inserted:,}")
+        # no index on payload_csv, no query filters or joins on it
         t_cur.execute("CREATE INDEX IF NOT EXISTS idx_temp_parent_id ON temp(parent_id)")
-        t_cur.execute("CREATE INDEX IF NOT EXISTS idx_temp_payload ON temp(payload_csv)")
-        tmp.commit()
 
         # sanity counts
-        t_cur.execute("SELECT COUNT(*) FROM temp WHERE recordtype = 1")
-        total_parents_raw = t_cur.fetchone()[0]
-        t_cur.execute("SELECT COUNT(*) FROM temp WHERE recordtype = 2")
-        total_children_raw = t_cur.fetchone()[0]
-        t_cur.execute("SELECT COUNT(*) FROM temp WHERE recordtype = 0")
-        total_singles_raw = t_cur.fetchone()[0]
+        total_singles_raw, total_parents_raw, total_children_raw = raw_counts
         print(
             f"[info] raw counts - parents: {total_parents_raw:,}, children: {total_children_raw:,}, singles: {total_singles_raw:,}"
         )
 
-        # ------------------------
-        # Stage 2: Build parent_map (id -> parent_payload) from ALL parent rows
-        # ------------------------
-        print("[info] building parent_map (id -> parent_payload) ...")
-        t_cur.execute("CREATE TABLE parent_map (id INTEGER PRIMARY KEY, parent_payload TEXT)")
-        t_cur.execute("SELECT COUNT(*) FROM temp WHERE recordtype = 1")
-        parent_rows_count = t_cur.fetchone()[0]
-        with tqdm(total=parent_rows_count, unit="rows", ncols=80, desc="Stage 2 - parent_map") as pbar:
-            cur = t_cur.execute("SELECT id, payload_csv FROM temp WHERE recordtype = 1")
-            batch = []
-            bs = 2000
-            processed = 0
-            for r in cur:
-                batch.append((r["id"], r["payload_csv"]))
-                if len(batch) >= bs:
-                    t_cur.executemany("INSERT INTO parent_map (id, parent_payload) VALUES (?,?)", batch)
-                    tmp.commit()
-                    processed += len(batch)
-                    pbar.update(len(batch))
-                    batch.clear()
-            if batch:
-                t_cur.executemany("INSERT INTO parent_map (id, parent_payload) VALUES (?,?)", batch)
-                tmp.commit()
-                processed += len(batch)
-                pbar.update(len(batch))
-                batch.clear()
-        t_cur.execute("CREATE INDEX IF NOT EXISTS idx_parent_map_payload ON parent_map(parent_payload)")
-        tmp.commit()
-        t_cur.execute("SELECT COUNT(*) FROM parent_map")
-        parent_map_count = t_cur.fetchone()[0]
-        print(f"[info] parent_map entries: {parent_map_count:,}")
-
         # ------------------------
         # Stage 3: Deduplicate parents by payload_csv (unique parent payloads)
         # ------------------------
         print("[info] deduplicating parents by payload...")
+        # the primary key rejects duplicates at insert time
+        # and keeps the table sorted by payload_csv, so there is no GROUP BY sort
+        # id is the first id seen for each payload
+        # the parent rows are read from temp, there is no parent_map copy of them
+        t_cur.execute("CREATE TABLE parents (payload_csv TEXT PRIMARY KEY, id INTEGER) WITHOUT ROWID")
         t_cur.execute(
             """
-            CREATE TABLE parents AS
-            SELECT MIN(id) AS id, parent_payload AS payload_csv
-            FROM parent_map
-            GROUP BY parent_payload
-            ORDER BY parent_payload
+            INSERT OR IGNORE INTO parents (payload_csv, id)
+            SELECT payload_csv, id
+            FROM temp
+            WHERE recordtype = 1
             """
         )
-        tmp.commit()
-        t_cur.execute("CREATE INDEX IF NOT EXISTS idx_parents_payload ON parents(payload_csv)")
-        tmp.commit()
-        t_cur.execute("SELECT COUNT(*) FROM parents")
-        unique_parents = t_cur.fetchone()[0]
+        # rowcount does not include the ignored duplicates
+        unique_parents = t_cur.rowcount
         print(f"[info] unique parent payloads: {unique_parents:,}")
 
         # ------------------------
         # Stage 4: Deduplicate children within their parent's payload
         # ------------------------
         print("[info] deduplicating children (group by parent_payload + child_payload) ...")
-        t_cur.execute("SELECT COUNT(*) FROM temp WHERE recordtype = 2")
-        children_raw_count = t_cur.fetchone()[0]
+        children_raw_count = total_children_raw
 
+        # the parents are read from temp in the same statement
+        # one scan over the parents, their children are found by idx_temp_parent_id
         t_cur.execute(
             """
-            CREATE TABLE children AS
-            SELECT MIN(t.id) AS id,
-                pm.parent_payload AS parent_payload,
-                t.payload_csv AS payload_csv
+            CREATE TABLE children (
+                parent_payload TEXT,
+                payload_csv TEXT,
+                id INTEGER,
+                PRIMARY KEY (parent_payload, payload_csv)
+            ) WITHOUT ROWID
+            """
+        )
+        t_cur.execute(
+            """
+            INSERT OR IGNORE INTO children (parent_payload, payload_csv, id)
+            WITH pm AS (
+                SELECT id, payload_csv AS parent_payload
+                FROM temp
+                WHERE recordtype = 1
+            )
+            SELECT pm.parent_payload, t.payload_csv, t.id
             FROM temp t
-            JOIN parent_map pm ON t.parent_id = pm.id
+            JOIN pm ON t.parent_id = pm.id
             WHERE t.recordtype = 2
-            GROUP BY pm.parent_payload, t.payload_csv
-            ORDER BY pm.parent_payload, t.payload_csv
             """
         )
-        tmp.commit()
-        t_cur.execute("CREATE INDEX IF NOT EXISTS idx_children_parent_payload ON children(parent_payload)")
-        tmp.commit()
-        t_cur.execute("SELECT COUNT(*) FROM children")
-        unique_children = t_cur.fetchone()[0]
+        unique_children = t_cur.rowcount
         print(
             f"[info] children: raw={children_raw_count:,}, unique_by_parent_payload={unique_children:,}"
         )
@@ -535,86 +365,75 @@ def convert_sqlite_to_csv(source_db, source_table, output_csv, keep_temp_db=True
         # Stage 5: Deduplicate singles (recordtype == 0)
         # ------------------------
         print("[info] deduplicating singles ...")
+        t_cur.execute("CREATE TABLE singles (payload_csv TEXT PRIMARY KEY, id INTEGER) WITHOUT ROWID")
         t_cur.execute(
             """
-            CREATE TABLE singles AS
-            SELECT MIN(id) AS id, payload_csv
+            INSERT OR IGNORE INTO singles (payload_csv, id)
+            SELECT payload_csv, id
             FROM temp
             WHERE recordtype = 0
-            GROUP BY payload_csv
-            ORDER BY payload_csv
             """
         )
-        tmp.commit()
-        t_cur.execute("SELECT COUNT(*) FROM singles")
-        unique_singles = t_cur.fetchone()[0]
+        unique_singles = t_cur.rowcount
         print(f"[info] unique singles: {unique_singles:,}")
 
-        # ------------------------
-        # Stage 6: Combine parents and singles into one table and sort by payload_csv
-        # This ensures parents and singles are emitted interleaved by payload order.
-        # ------------------------
-        print("[info] combining parents and singles (preserve recordtype 1=parent,0=single) ...")
-        t_cur.execute("DROP TABLE IF EXISTS parent_single")
-        t_cur.execute(
-            """
-            CREATE TABLE parent_single AS
-            SELECT 1 AS recordtype, payload_csv
-            FROM parents
-            UNION ALL
-            SELECT 0 AS recordtype, payload_csv
-            FROM singles
-            """
-        )
-        tmp.commit()
-        t_cur.execute("CREATE INDEX IF NOT EXISTS idx_parent_single_payload ON parent_single(payload_csv)")
-        tmp.commit()
-        t_cur.execute("SELECT COUNT(*) FROM parent_single")
-        cnt_parent_single = t_cur.fetchone()[0]
-        print(f"[info] parent_single rows (parents+singles): {cnt_parent_single:,}")
+        # parents and singles are merged while writing the CSV
+        cnt_parent_single = unique_parents + unique_singles
+        print(f"[info] parent and single rows: {cnt_parent_single:,}")
+
+        t_cur.execute("COMMIT")
+
+    if sql_payload:
+        t_cur.execute("DETACH DATABASE src")
 
     # ------------------------
     # Stage 7: Write final CSV
     # ------------------------
     print("[info] writing CSV ...")
     # Estimate output rows for progress bar
-    t_cur.execute("SELECT COUNT(*) FROM parent_single")
-    cnt_parsing_out = t_cur.fetchone()[0]
-    t_cur.execute("SELECT COUNT(*) FROM children")
-    cnt_children_out = t_cur.fetchone()[0]
+    cnt_parsing_out = cnt_parent_single
+    cnt_children_out = unique_children
     total_out_rows = cnt_parsing_out + cnt_children_out
     print(
         f"[info] output rows estimate: parent/singles={cnt_parsing_out:,}, children={cnt_children_out:,} -> total={total_out_rows:,}"
     )
 
-    with open(output_csv, "w", newline="", encoding="utf-8") as outf:
+    with open(output_csv, "w", newline="", encoding="utf-8", buffering=1 << 20) as outf:
         writer = csv.writer(outf, delimiter=";", quoting=csv.QUOTE_MINIMAL)
         writer.writerow(["recordtype_int"] + payload_cols)
+        # the payloads are already quoted CSV with the same delimiter
+        # so rows are written as raw lines, with the line terminator of csv.writer
+        # one writelines call consumes all lines from a generator
 
-        with tqdm(total=total_out_rows, unit="rows", ncols=80, desc="Stage 7 - write CSV") as pbar:
+        def csv_lines():
             # Parent & single rows mixed, sorted by payload_csv
-            # NOTE we need a different cursor for the nested query
-            t_cur_2 = tmp.cursor()
-            cur = t_cur.execute("SELECT recordtype, payload_csv FROM parent_single ORDER BY payload_csv")
-
-            for r in cur:
+            # parents and singles are stored in payload order (primary key)
+            # so heapq.merge interleaves them without a sort
+            # on equal payloads, the parent comes first
+            # children sorted by parent_payload, so they can be merged too
+            # NOTE we need a different cursor for each query
+            child_cur = tmp.cursor().execute(
+                "SELECT parent_payload, payload_csv FROM children ORDER BY parent_payload, payload_csv"
+            )
+            next_child = next(child_cur, None)
+            parent_cur = tmp.cursor().execute("SELECT 1 AS recordtype, payload_csv FROM parents ORDER BY payload_csv")
+            single_cur = tmp.cursor().execute("SELECT 0 AS recordtype, payload_csv FROM singles ORDER BY payload_csv")
+
+            for r in heapq.merge(parent_cur, single_cur, key=lambda r: r["payload_csv"]):
                 rt = r["recordtype"]
                 payload = r["payload_csv"]
                 if rt == 1:
                     # parent: emit parent row then its children
-                    writer.writerow([1] + deserialize_payload(payload))
-                    pbar.update(1)
+                    yield f"1;{payload}\r\n"
                     # emit children (deduped by parent_payload)
-                    for child in t_cur_2.execute(
-                        "SELECT payload_csv FROM children WHERE parent_payload = ? ORDER BY payload_csv",
-                        (payload,),
-                    ):
-                        writer.writerow([2] + deserialize_payload(child["payload_csv"]))
-                        pbar.update(1)
+                    while next_child is not None and next_child["parent_payload"] == payload:
+                        yield f"2;{next_child['payload_csv']}\r\n"
+                        next_child = next(child_cur, None)
                 else:
                     # single: emit single row
-                    writer.writerow([0] + deserialize_payload(payload))
-                    pbar.update(1)
+                    yield f"0;{payload}\r\n"
+
+        outf.writelines(tqdm(csv_lines(), total=total_out_rows, unit="rows", ncols=80, desc="Stage 7 - write CSV"))
 
     print(f"[info] CSV written to: {output_csv}")
 
@@ -631,6 +450,106 @@ def convert_sqlite_to_csv(source_db, source_table, output_csv, keep_temp_db=True
             print(f"[warning] failed to remove temp DB: {e}")
 
 
+def convert_sqlite_to_csv_in_memory(source_db, source_table, output_csv):
+    """Same output as convert_sqlite_to_csv, without the temporary database.
+
+    Parents, children and singles are deduplicated in Python sets and dicts,
+    so this needs memory for all unique payloads.
+    """
+    if os.path.exists(output_csv):
+        os.unlink(output_csv)
+
+    # plain tuples, no sqlite3.Row name lookups per column
+    src = sqlite3.connect(source_db)
+    s_cur = src.cursor()
+
+    all_cols, payload_cols = get_payload_cols(s_cur, source_table)
+    payload_idx, id_idx, parent_id_idx, recordtype_idx = get_column_indices(all_cols, payload_cols)
+
+    # count rows for progress
+    s_cur.execute(f"SELECT COUNT(*) FROM {source_table}")
+    num_source_rows = s_cur.fetchone()[0]
+    print(f"[info] source rows: {num_source_rows:,}")
+
+    # ------------------------
+    # Pass 1: route serialized payloads by recordtype
+    # ------------------------
+    parent_map = dict() # id -> parent_payload
+    children_by_parent_id = dict() # parent_id -> child payloads
+    singles = set()
+
+    s_cur.execute(f"SELECT * FROM {source_table}")
+    batch_size = 50_000
+    with tqdm(total=num_source_rows, unit="rows", ncols=80, desc="Pass 1 - read") as pbar:
+        while True:
+            rows = s_cur.fetchmany(batch_size)
+            if not rows:
+                break
+            payloads = serialize_payloads(rows, payload_cols, payload_idx)
+            for row, payload_csv in zip(rows, payloads):
+                rt = recordtype_to_int(row[recordtype_idx]) if recordtype_idx is not None else 0
+                if rt == 1:
+                    parent_map[row[id_idx]] = payload_csv
+                elif rt == 2:
+                    children_by_parent_id.setdefault(row[parent_id_idx], set()).add(payload_csv)
+                else:
+                    singles.add(payload_csv)
+            pbar.update(len(rows))
+
+    src.close()
+
+    # deduplicate children by parent_payload
+    # children without a known parent are dropped, like in the JOIN of convert_sqlite_to_csv
+    children = dict() # parent_payload -> child payloads
+    for parent_id, child_payloads in children_by_parent_id.items():
+        parent_payload = parent_map.get(parent_id)
+        if parent_payload is None:
+            continue
+        children.setdefault(parent_payload, set()).update(child_payloads)
+    del children_by_parent_id
+
+    parents = set(parent_map.values())
+    del parent_map
+
+    print(
+        f"[info] unique payloads - parents: {len(parents):,}, children: {sum(map(len, children.values())):,}, singles: {len(singles):,}"
+    )
+
+    # parents and singles sorted by payload
+    # python compares str by code point, which is the same order as BINARY on UTF-8 in SQLite
+    # on equal payloads, the parent comes first
+    parent_single = sorted(
+        [(payload, 0) for payload in parents] + [(payload, 1) for payload in singles]
+    )
+    total_out_rows = len(parent_single) + sum(map(len, children.values()))
+
+    # ------------------------
+    # Pass 2: Write final CSV
+    # ------------------------
+    print("[info] writing CSV ...")
+    with open(output_csv, "w", newline="", encoding="utf-8", buffering=1 << 20) as outf:
+        writer = csv.writer(outf, delimiter=";", quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(["recordtype_int"] + payload_cols)
+        # the payloads are already quoted CSV with the same delimiter
+        # so rows are written as raw lines, with the line terminator of csv.writer
+        # one writelines call consumes all lines from a generator
+
+        def csv_lines():
+            for payload, is_single in parent_single:
+                if not is_single:
+                    # parent: emit parent row then its children
+                    yield f"1;{payload}\r\n"
+                    for child_payload in sorted(children.get(payload, ())):
+                        yield f"2;{child_payload}\r\n"
+                else:
+                    # single: emit single row
+                    yield f"0;{payload}\r\n"
+
+        outf.writelines(tqdm(csv_lines(), total=total_out_rows, unit="rows", ncols=80, desc="Pass 2 - write CSV"))
+
+    print(f"[info] CSV written to: {output_csv}")
+
+
 if __name__ == "__main__":
     # if len(sys.argv) != 4:
     #     print(f"Usage: {sys.argv[0]} SOURCE_DB TABLE_NAME OUTPUT_CSV")
@@ -641,4 +560,11 @@ if __name__ == "__main__":
     source_table = "telefonbuch"
     output_csv = "telefonbuch.csv"
 
-    convert_sqlite_to_csv(source_db, source_table, output_csv)
+    # deduplicate in memory instead of in a temporary database
+    # faster, but needs memory for all unique payloads
+    in_memory = False
+
+    if in_memory:
+        convert_sqlite_to_csv_in_memory(source_db, source_table, output_csv)
+    else:
+        convert_sqlite_to_csv(source_db, source_table, output_csv)
@@ -5,9 +5,8 @@
 
 import os
 import re
-import io
+import json
 import sys
-import csv
 import time
 import shlex
 import string
@@ -71,18 +70,6 @@ query_name_length = 2
 # hate these idiots... all text should be utf8
 text_encoding = 'latin1'
 
-# also: bad data: utf8 bytes interpreted as latin1 bytes
-# "MÃ¼nchen".encode("latin1").decode("utf8") == "München"
-# TODO postprocess data: use chardet or charset_normalizer library to fix encoding
-# must work with short strings
-# should let me suggest encodings (latin1, utf8)
-# simple fix...? how can this go wrong?
-def fix_encoding(input_str):
-    try:
-        return input_str.encode("latin1").decode("utf8")
-    except UnicodeDecodeError:
-        return input_str
-
 telefonbuch_columns = {
     "name0": str,
     "firstname0": str,
@@ -112,20 +99,34 @@ telefonbuch_columns = {
     "recordtype": ("single", "parent", "child"),
 }
 
-sessionid_regex = b'<sessionid>([0-9]+)</sessionid>'
-
-# <hitcount>0</hitcount>
-num_results_regex = b'<hitcount>([0-9]+)</hitcount>'
-
-# <perpage>15</perpage>
-results_per_page_regex = b'<perpage>([0-9]+)</perpage>'
+sessionid_regex = re.compile(b'<sessionid>([0-9]+)</sessionid>')
 
 # <refresh><percentcomplete>0,0</percentcomplete><seconds>16</seconds></refresh>
 search_results_are_loading_bytes = b'<refresh><percentcomplete>'
 
+# fixed params of the search requests, encoded once
+# database=whitepages&lastdatabase=whitepages&city=
+search_base_query_string = urllib.parse.urlencode([
+    ('database', 'whitepages'),
+    ('lastdatabase', 'whitepages'),
+    ('city', ''),
+])
+
+# one parser for all result pages
+# the pages have no id attributes and no DTD
+result_page_parser = lxml.etree.XMLParser(
+    collect_ids=False,
+    resolve_entities=False,
+    no_network=True,
+)
+
+# top-level addresses of a result page
+# <root><results><entries><address>, see doc/example-result.xml
+# compiled once, not per page
+result_page_addresses = lxml.etree.XPath("results/entries/address")
+
 # quiet!
 # TODO also disable debug logging from aiohttp_chromium.extensions
-import logging
 logging.getLogger("aiohttp_chromium.client").setLevel("INFO")
 
 
@@ -133,6 +134,8 @@ logging.getLogger("aiohttp_chromium.client").setLevel("INFO")
 server_process = None
 query_offset = 0
 num_results = -1
+# parsed rows which are not yet inserted
+pending_rows = []
 
 
 def start_server():
@@ -215,33 +218,47 @@ class NextIdCounter:
         self.next_id += 1
 
 
-def parse_address(address_elem, next_id_counter, parent_id=None, rows=None):
-    """Recursively parse <address> elements into flat rows."""
-    global telefonbuch_columns
-    # NOTE next_id is wrapped in a list to make it a "mutable reference"
-    if rows is None:
-        rows = []
-
-    # predicted row ID
-    current_id = next_id_counter.get()
-    next_id_counter.increment()
+# position of each column in the row tuples of parse_address
+# after id and parent_id
+telefonbuch_column_index = {col: 2 + idx for idx, col in enumerate(telefonbuch_columns.keys())}
+num_row_values = 2 + len(telefonbuch_columns)
 
-    # Extract all known columns
-    row = {"id": current_id, "parent_id": parent_id}
-    for col in telefonbuch_columns.keys():
-        elem = address_elem.find(col)
-        if elem is not None and elem.text:
-            row[col] = elem.text.strip()
-        else:
-            row[col] = None
 
-    rows.append(row)
+def parse_address(address_elem, next_id_counter, parent_id=None):
+    """Parse nested <address> elements into flat rows, parents before children.
 
-    # loop direct child address elements
-    # findall means "Find all <address> elements that are immediate children of this element."
-    for child in address_elem.findall("address"):
-        # recurse
-        parse_address(child, next_id_counter, parent_id=current_id, rows=rows)
+    Rows are tuples of id, parent_id and the telefonbuch_columns values.
+    """
+    rows = []
+
+    # explicit stack instead of recursion
+    # children are pushed in reverse, so they are popped in document order
+    stack = [(address_elem, parent_id)]
+    while stack:
+        address_elem, parent_id = stack.pop()
+
+        # predicted row ID
+        current_id = next_id_counter.get()
+        next_id_counter.increment()
+
+        # Extract all known columns
+        # one pass over the child elements, instead of one find per column
+        row = [None] * num_row_values
+        row[0] = current_id
+        row[1] = parent_id
+        child_addresses = []
+        for elem in address_elem:
+            tag = elem.tag
+            if tag in telefonbuch_column_index:
+                if elem.text:
+                    row[telefonbuch_column_index[tag]] = elem.text.strip()
+            elif tag == "address":
+                child_addresses.append(elem)
+
+        rows.append(tuple(row))
+
+        for child in reversed(child_addresses):
+            stack.append((child, current_id))
 
     return rows
 
@@ -260,12 +277,22 @@ async def main():
         # HTTP status codes to retry
         statuses={500, 502, 503, 504},
         # retry on network/timeouts
-        exceptions={Exception},
+        # but not on programming errors
+        exceptions={aiohttp.ClientError, asyncio.TimeoutError},
     )
     # total response timeout
     # the default timeout is None so requests can hang forever
     timeout = aiohttp.ClientTimeout(total=30)
+    # one small pool of keep-alive connections to the local server
+    # HTTP/1.1 connections are kept alive by default
+    connector = aiohttp.TCPConnector(
+        limit=4,
+        limit_per_host=4,
+        force_close=False,
+        keepalive_timeout=60,
+    )
     kwargs = dict(
+        connector=connector,
         # raise_for_status=True,  # raise exceptions on bad status codes
         raise_for_status=False,
         retry_options=retry_options,
@@ -287,6 +314,23 @@ async def main_inner(session):
     db_con = sqlite3.connect(db_path)
     db_cur = db_con.cursor()
 
+    # Bulk load settings
+    # WAL with synchronous NORMAL does not fsync on every commit
+    # and a crash can only lose the last committed query_names
+    # which are scraped again on the next run
+    # page_size only has an effect before the first table is created
+    # an existing database keeps its page size
+    db_cur.execute("PRAGMA page_size = 8192")
+    # we are the only writer for the whole run
+    # so the lock is taken once, and WAL needs no shared memory index
+    # this must be set before journal_mode = WAL
+    db_cur.execute("PRAGMA locking_mode = EXCLUSIVE")
+    db_cur.execute("PRAGMA journal_mode = WAL")
+    db_cur.execute("PRAGMA synchronous = NORMAL")
+    db_cur.execute("PRAGMA temp_store = MEMORY")
+    db_cur.execute("PRAGMA cache_size = -262144") # 256 MiB
+    db_cur.execute("PRAGMA mmap_size = 2147483648") # 2 GiB
+
     # transaction start
     # get exclusive write access
     db_con.execute("BEGIN EXCLUSIVE")
@@ -296,10 +340,8 @@ async def main_inner(session):
     query_offset = -1
     num_results = -1
 
-    # NOTE SQLite does not check foreign keys by default
-    # so FOREIGN KEY constraints are silently ignored.
-    # to enable checking foreign keys:
-    # conn.execute("PRAGMA foreign_keys = ON;")
+    # no FOREIGN KEY on parent_id
+    # SQLite does not check foreign keys by default, so it was never enforced
     sql = (
         "CREATE TABLE IF NOT EXISTS telefonbuch_scrape (\n"
         "  id INTEGER PRIMARY KEY,\n"
@@ -308,15 +350,18 @@ async def main_inner(session):
         "  query_offset INTEGER,\n"
         "  query_child_num INTEGER,\n"
         +
+        # no CHECK constraints here
+        # one malformed row from the server would abort the whole scrape
+        # csv2sqlite.py adds them to the final database
         ",\n".join(map(lambda k: f"  {k} TEXT", telefonbuch_columns.keys()))
         +
-        ",\n"
-        "  FOREIGN KEY (parent_id) REFERENCES telefonbuch_scrape (id)\n"
-        ")"
+        "\n)"
     )
     db_cur.execute(sql)
 
-    if 1:
+    # the unique index is created after the scrape
+    # so the inserts dont have to update it
+    def create_query_index():
         sql = (
             "CREATE UNIQUE INDEX IF NOT EXISTS telefonbuch_scrape_query_name_query_offset ON telefonbuch_scrape (\n"
             "  query_name,\n"
@@ -326,48 +371,16 @@ async def main_inner(session):
         )
         db_cur.execute(sql)
 
-    xml_header = '<?xml version="1.0" encoding="UTF-8" standalone="no" ?>'
-    xslt_url_regex = r'<\?xml-stylesheet type="text/xsl" href="([^"]+)"\?>'
-
-    xslt_transform_cache = dict()
-
-    async def render_html(xml_bytes):
-        if not request_xml:
-            return xml_bytes
-        # global xslt_transform_cache
-        if not xml_bytes.startswith(xml_header):
-            return xml_bytes
-        match = re.search(xslt_url_regex, xml_bytes)
-        if not match:
-            return xml_bytes
-        xslt_url = base_url + "/" + match.group(1)
-        xslt_transform = xslt_transform_cache.get(xslt_url)
-        if not xslt_transform:
-            logger.info(f"xslt_url: {xslt_url}")
-            async with session.get(xslt_url) as response:
-                assert response.status == 200, f"bad response.status {response.status}"
-                xslt_text = await response.read()
-            xslt_doc = lxml.etree.fromstring(xslt_text.encode('utf8')) # latin1?
-            # FIXME lxml.etree.XSLTParseError: Cannot resolve URI string://__STRING__XSLT__/common.xsl
-            xslt_transform = lxml.etree.XSLT(xslt_doc)
-            xslt_transform_cache[xslt_url] = xslt_transform
-        xml_text = xml_bytes
-        xml_doc = lxml.etree.fromstring(xml_text.encode('utf-8')) # latin1?
-        html_doc = xslt_transform(xml_doc)
-        xml_bytes = str(html_doc)
-        return xml_bytes
-
     async def get_sessionid():
         # get sessionid
         logger.info(f"getting sessionid")
         sessionid = 0
         url = base_url
-        if debug: logger.debug(f"url: {url}")
+        logger.debug("url: %s", url)
         async with session.get(url) as response:
             assert response.status == 200, f"bad response.status {response.status}"
             xml_bytes = await response.read()
-            # xml_bytes = await render_html(xml_bytes)
-            if match := re.search(sessionid_regex, xml_bytes):
+            if match := sessionid_regex.search(xml_bytes):
                 sessionid = int(match.group(1))
             else:
                 raise ValueError(f"failed to parse sessionid from xml_bytes:\n\n{xml_bytes}")
@@ -384,7 +397,7 @@ async def main_inner(session):
         ]
         query_string = urllib.parse.urlencode(params)
         url = f"{base_url}/telefonbuch.cgi?{query_string}"
-        if debug: logger.debug(f"url: {url}")
+        logger.debug("url: %s", url)
         async with session.get(url) as response:
             assert response.status == 200, f"bad response.status {response.status}"
             # logger.debug("xml_bytes:"); logger.debug(await response.read())
@@ -406,7 +419,7 @@ async def main_inner(session):
         ]
         query_string = urllib.parse.urlencode(params)
         url = f"{base_url}/telefonbuch.cgi?{query_string}"
-        if debug: logger.debug(f"url: {url}")
+        logger.debug("url: %s", url)
         async with session.get(url) as response:
             assert response.status == 200, f"bad response.status {response.status}"
             # logger.debug("xml_bytes:"); logger.debug(await response.read())
@@ -414,37 +427,35 @@ async def main_inner(session):
             # parse?
         # await asyncio.sleep(1)
 
-    async def get_search_results():
+    def search_url(extra_query_string):
+        """URL of a search request for query_name, with an encoded extra query string.
+
+        Only query_name is encoded per request.
+        The param order is the same as in the full params list.
+        """
+        return (
+            f"{base_url}/telefonbuch.cgi?sessionid={sessionid}&{search_base_query_string}"
+            f"&name={urllib.parse.quote_plus(query_name)}&firstname="
+            f"&{extra_query_string}"
+        )
+
+    async def get_search_results(query_offset):
         global num_results
         # start search and get num_results
-        logger.debug(f"query_name={query_name!r} query_offset={query_offset}/{num_results}: getting search results")
+        logger.debug("query_name=%r query_offset=%s/%s: getting search results", query_name, query_offset, num_results)
         # logger.debug(f"query_name={query_name!r} query_offset={query_offset}: getting search results")
         num_results = -1
-        # if debug: time.sleep(2)
-        params = [
-            ('sessionid', sessionid),
-            ('database', 'whitepages'),
-            ('lastdatabase', 'whitepages'),
-            ('city', ''),
-            ('name', query_name),
-            ('firstname', ''),
-            # ('results_per_page', results_per_page),
-        ]
+        # ('results_per_page', results_per_page),
         if query_offset == 0:
-            params += [
-                ('btnhidden', "Suchen"),
-            ]
+            url = search_url("btnhidden=Suchen")
         else:
-            params += [
-                # ('startrecord', query_offset),
-                ('startrecord', 0),
-                ('btnpage', 1 + (query_offset // max_results_per_page)), # startrecord = 0
-            ]
+            # ('startrecord', query_offset),
+            btnpage = 1 + (query_offset // max_results_per_page) # startrecord = 0
+            url = search_url(f"startrecord=0&btnpage={btnpage}")
 
-        query_string = urllib.parse.urlencode(params)
-        url = f"{base_url}/telefonbuch.cgi?{query_string}"
-        if debug: logger.debug(f"url: {url}")
+        logger.debug("url: %s", url)
         xml_bytes = b""
+        xml_root = None
         for retry_idx in range(1000):
             async with session.get(url) as response:
                 assert response.status == 200, f"bad response.status {response.status}"
@@ -454,8 +465,12 @@ async def main_inner(session):
                     await asyncio.sleep(0.1)
                     continue # retry
                 # logger.debug("xml_bytes:"); logger.debug(xml_bytes); sys.exit() # debug
-                if match := re.search(num_results_regex, xml_bytes):
-                    num_results = int(match.group(1))
+                # parse xml once
+                # the caller reads the addresses from the same tree
+                xml_root = lxml.etree.fromstring(xml_bytes, result_page_parser)
+                # <root><results><hitcount>0</hitcount>
+                if (hitcount := xml_root.findtext("results/hitcount")) is not None:
+                    num_results = int(hitcount)
                 else:
                     logger.error(f"query_name={query_name!r}: FIXME not found num_results in xml_bytes:")
                     print(xml_bytes)
@@ -471,27 +486,17 @@ async def main_inner(session):
             print(xml_bytes)
             sys.exit(1)
 
-        return num_results, xml_bytes
+        return num_results, xml_root
 
     async def select_results():
-        # if debug: time.sleep(2)
-        logger.debug(f"query_name={query_name!r} query_offset={query_offset}/{num_results}: selecting results")
+        logger.debug("query_name=%r query_offset=%s/%s: selecting results", query_name, query_offset, num_results)
         # select results
-        params = [
-            ('sessionid', sessionid),
-            ('database', 'whitepages'),
-            ('lastdatabase', 'whitepages'),
-            ('city', ''),
-            ('name', query_name),
-            ('firstname', ''),
-            ('btnselect', 'Alle+Einträge+markieren'), # search + select results
-            # ('results_per_page', results_per_page),
-            ('startrecord', query_offset),
-            # ('btnpage', 1 + (query_offset // max_results_per_page)), # startrecord = 0
-        ]
-        query_string = urllib.parse.urlencode(params)
-        url = f"{base_url}/telefonbuch.cgi?{query_string}"
-        if debug: logger.debug(f"url: {url}")
+        # search + select results
+        # ('results_per_page', results_per_page),
+        # ('btnpage', 1 + (query_offset // max_results_per_page)), # startrecord = 0
+        btnselect = urllib.parse.quote_plus('Alle+Einträge+markieren')
+        url = search_url(f"btnselect={btnselect}&startrecord={query_offset}")
+        logger.debug("url: %s", url)
         async with session.get(url) as response:
             assert response.status == 200, f"bad response.status {response.status}"
             # logger.debug("xml_bytes:"); logger.debug(await response.read())
@@ -504,23 +509,13 @@ async def main_inner(session):
 
     async def unselect_results():
         # unselect results
-        logger.debug(f"query_name={query_name!r}: unselecting results")
-        params = [
-            ('sessionid', sessionid),
-            ('database', 'whitepages'),
-            ('lastdatabase', 'whitepages'),
-            ('city', ''),
-            ('name', query_name),
-            ('firstname', ''),
-            ('btnunselect', 'Markierung+aufheben'), # search + unselect all
-            # ('results_per_page', results_per_page),
-        ]
-        for i in range(results_per_page):
-            params.append((f"rs{query_offset + i}", "0"))
-        params.append(('startrecord', query_offset))
-        query_string = urllib.parse.urlencode(params)
-        url = f"{base_url}/telefonbuch.cgi?{query_string}"
-        if debug: logger.debug(f"url: {url}")
+        logger.debug("query_name=%r: unselecting results", query_name)
+        # search + unselect all
+        # ('results_per_page', results_per_page),
+        btnunselect = urllib.parse.quote_plus('Markierung+aufheben')
+        rs_params = "".join(f"&rs{query_offset + i}=0" for i in range(results_per_page))
+        url = search_url(f"btnunselect={btnunselect}{rs_params}&startrecord={query_offset}")
+        logger.debug("url: %s", url)
         async with session.get(url) as response:
             assert response.status == 200, f"bad response.status {response.status}"
             # logger.debug("xml_bytes:"); logger.debug(await response.read())
@@ -606,8 +601,63 @@ async def main_inner(session):
         +
         ")"
     )
-    if debug:
-        logger.debug(f"sql_insert_result:\n{sql_insert_result}")
+    logger.debug("sql_insert_result:\n%s", sql_insert_result)
+
+    # one INSERT statement with many VALUES rows
+    # limited by the max number of ? variables per statement
+    max_variables = db_con.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+    multi_insert_num_rows = min(500, max_variables // len(insert_columns))
+    sql_multi_insert_result = (
+        "INSERT INTO telefonbuch_scrape (\n"
+        +
+        ",\n".join(insert_columns)
+        +
+        "\n) VALUES\n"
+        +
+        ",\n".join(["(" + ",".join("?" for _ in insert_columns) + ")"] * multi_insert_num_rows)
+    )
+
+    def flush_pending_rows():
+        # full batches with the multi-row INSERT
+        # the rest with one executemany
+        num_multi_rows = len(pending_rows) - len(pending_rows) % multi_insert_num_rows
+        for start in range(0, num_multi_rows, multi_insert_num_rows):
+            batch = pending_rows[start:(start + multi_insert_num_rows)]
+            db_cur.execute(sql_multi_insert_result, list(itertools.chain.from_iterable(batch)))
+        db_cur.executemany(sql_insert_result, pending_rows[num_multi_rows:])
+        pending_rows.clear()
+
+    # max number of rows in pending_rows
+    # flushed rows are still part of the open transaction
+    pending_rows_limit = 10_000
+
+    # predict the next inserted rowid
+    # this is the only SELECT MAX(id)
+    # NOTE this is why: db_con.execute("BEGIN EXCLUSIVE")
+    next_id = db_cur.execute("SELECT COALESCE(MAX(id), 0) FROM telefonbuch_scrape").fetchone()[0] + 1
+    next_id_counter = NextIdCounter(next_id)
+
+    # query_names which were already processed
+    # assume atomic inserts per query_name (transaction start + transaction end)
+    # one scan here, instead of one query per query_name
+    done_query_names = set(
+        row[0] for row in db_cur.execute("SELECT DISTINCT query_name FROM telefonbuch_scrape")
+    )
+
+    # num_results per query_name, from this and previous runs
+    # sidecar file of the database
+    query_hits_path = "telefonbuch-scrape-hits.json"
+    try:
+        with open(query_hits_path) as f:
+            query_hits = json.load(f)
+    except FileNotFoundError:
+        query_hits = dict()
+
+    def save_query_hits():
+        tmp_path = query_hits_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(query_hits, f)
+        os.replace(tmp_path, query_hits_path)
 
     query_name_list = []
     for query_name in itertools.product(query_name_alphabet, repeat=query_name_length):
@@ -616,187 +666,167 @@ async def main_inner(session):
             continue
         query_name_list.append(query_name)
 
+    # do the query_names with known results first
+    # num_results is only recorded for searched query_names
+    # and finished query_names are skipped anyway
+    # so this only moves a query_name that was interrupted in a previous run
+    # to the front, instead of leaving it in alphabet order
+    # the sort is stable, so the first run keeps the alphabet order
+    query_name_list.sort(key=lambda query_name: -query_hits.get(query_name, 0))
+
     # query_name_list = ["aa"] # debug
     # query_name_list = ["ma"] # debug
 
-    for query_idx, query_name in enumerate(query_name_list):
+    try:
+        for query_idx, query_name in enumerate(query_name_list):
 
-        # check if this query_name was already processed
-        # assume atomic inserts per query_name (transaction start + transaction end)
-        sql = "SELECT 1 FROM telefonbuch_scrape WHERE query_name = ?"
-        args = (query_name,)
-        res = db_cur.execute(sql, args).fetchone()
-        if not res is None:
-            # exists in database
-            if debug: logger.debug(f"query_name={query_name!r}: exists in database")
-            continue
+            # check if this query_name was already processed
+            if query_name in done_query_names:
+                # exists in database
+                logger.debug("query_name=%r: exists in database", query_name)
+                continue
 
-        # restart_server(); sessionid = await get_sessionid()
+            # restart_server(); sessionid = await get_sessionid()
 
-        query_offset = 0
-        last_xml_bytes = None
-        num_results = -1
+            query_offset = 0
+            last_xml_root = None
+            num_results = -1
 
-        if debug:
-            # query_offset = 11444 - 10 # 11444 is num_results for query_name="aa" # 11434
-            pass
+            if debug:
+                # query_offset = 11444 - 10 # 11444 is num_results for query_name="aa" # 11434
+                pass
 
-        num_results, xml_bytes = await get_search_results()
+            num_results, xml_root = await get_search_results(query_offset)
 
-        if num_results == 0:
-            if debug: logger.debug(f"query_name={query_name!r}: no results")
-            continue
+            query_hits[query_name] = num_results
+            save_query_hits()
+
+            if num_results == 0:
+                logger.debug("query_name=%r: no results", query_name)
+                continue
+
+            query_progress = ((query_idx + 1) / len(query_name_list))
+            logger.info(f"query_name={query_name!r}: query {query_idx + 1} of {len(query_name_list)} = {query_progress * 100:.2f}%")
+
+            logger.debug("query_name=%r: num_results=%s", query_name, num_results)
+
+            with tqdm(total=num_results, desc=query_name, unit="rows", ncols=80) as progressbar:
+
+                # transaction start
+                # ensure atomic inserts per query_name
+                # db_con.execute("BEGIN")
+
+                loop_idx = -1
+
+                query_offsets = range(0, (num_results + 1), results_per_page)
+
+                # fetch of the next page
+                # runs while this page is parsed and inserted
+                next_search_results = None
+
+                try:
+                    for query_offset in query_offsets:
+
+                        loop_idx += 1
+
+                        # logger.debug(f"query_name={query_name!r} query_offset={query_offset}/{num_results}")
+
+                        if loop_idx > 0:
+                            num_results, xml_root = await next_search_results
 
-        query_progress = ((query_idx + 1) / len(query_name_list))
-        logger.info(f"query_name={query_name!r}: query {query_idx + 1} of {len(query_name_list)} = {query_progress * 100:.2f}%")
+                        # request the next page only after this page was received
+                        # so the server still gets one request at a time
+                        next_query_offset = query_offset + results_per_page
+                        if next_query_offset in query_offsets:
+                            next_search_results = asyncio.create_task(get_search_results(next_query_offset))
+                            # let the task send its request before we block the event loop
+                            await asyncio.sleep(0)
 
-        if debug:
-            logger.debug(f"query_name={query_name!r}: num_results={num_results}")
+                        # await unselect_results()
 
-        with tqdm(total=num_results, desc=query_name, unit="rows", ncols=80) as progressbar:
+                        # print(lxml.etree.tostring(xml_root)); sys.exit()
 
-            # transaction start
-            # ensure atomic inserts per query_name
-            # db_con.execute("BEGIN")
+                        # <perpage>15</perpage>
+                        # the page size is fixed per session, so check only the first page
+                        # and dont search the whole tree of every page
+                        if loop_idx == 0 and (perpage := xml_root.findtext(".//perpage")) is not None:
+                            actual_results_per_page = int(perpage)
+                            assert actual_results_per_page == results_per_page, \
+                                f"results_per_page: actual={actual_results_per_page} != expected={results_per_page}"
 
-            loop_idx = -1
+                        # Find all top-level addresses
+                        # a direct path, not a search of the whole tree
+                        all_rows = []
+                        for addr in result_page_addresses(xml_root):
+                            # # Only process top-level (non-child) addresses
+                            # # i.e., skip <address> elements that have an ancestor <address>
+                            # recordtype_elem = addr.find("recordtype")
+                            # if recordtype_elem is not None and recordtype_elem.text == "child":
+                            #     continue
+                            rows = parse_address(addr, next_id_counter)
+                            all_rows.extend(rows)
 
-            for query_offset in range(0, (num_results + 1), results_per_page):
+                        # # Prepare executemany data
+                        # the rows are tuples in this column order
+                        # columns = ["id", "parent_id"] + list(telefonbuch_columns.keys())
+                        # placeholders = ", ".join(["?" for _ in columns])
+                        # insert_sql = f"INSERT INTO addresses ({', '.join(columns)}) VALUES ({placeholders})"
 
-                loop_idx += 1
+                        # sql_rows = [
+                        #     tuple(row.get(col) for col in columns)
+                        #     for row in all_rows
+                        # ]
 
-                # logger.debug(f"query_name={query_name!r} query_offset={query_offset}/{num_results}")
-
-                if loop_idx > 0:
-                    num_results, xml_bytes = await get_search_results()
-
-                # # TODO? parse num_results
-                # # <p id="results">11444 Treffer gefunden.
-                # #       <input type="hidden" name="startrecord" value="11443">
-                # # </p>
-                # if csv_str.startswith(csv_no_results_header):
-                #     # not reached?
-                #     # see query_offset_is_out_of_range
-                #     logger.info(f"query_name={query_name!r} query_offset={query_offset}/{num_results}: result is empty -> done query_name {query_name!r}")
-                #     # stop looping query_offset, go to next query_name
-                #     last_csv_str = ""
-                #     await unselect_results()
-                #     break
-
-                # # logger.debug("csv_str:")
-                # # logger.debug(csv_str)
-
-                # # time.sleep(1)
-                # # sys.exit()
-
-                # csv_buffer = io.StringIO(csv_str)
-                # csv_reader = csv.DictReader(csv_buffer)
-                # assert csv_reader.fieldnames == list(telefonbuch_columns.keys()), \
-                #     f"query_name={query_name!r} query_offset={query_offset}: bad csv_reader.fieldnames: {csv_reader.fieldnames}"
-                # columns = csv_reader.fieldnames
-
-                # # logger.debug(f"query_name={query_name!r} query_offset={query_offset}/{num_results}: num rows: {len(csv_reader)}")
-                # # logger.debug(f"query_name={query_name!r} query_offset={query_offset}/{num_results}: len(csv_str)={len(csv_str)}")
-                # # logger.debug(f"query_name={query_name!r} query_offset={query_offset}/{num_results}: csv_str={repr(csv_str)[:10000]}")
-
-                # # NOTE we can use csv_reader only once
-                # sql_rows = []
-                # for row_idx, row in enumerate(csv_reader):
-                #     sql_rows.append((
-                #         query_name,
-                #         query_offset + row_idx,
-                #         *tuple(row[col] for col in columns)
-                #     ))
-
-                # if debug:
-                #     print_results(columns, sql_rows)
-
-                # if len(sql_rows) > results_per_page:
-                #     raise ValueError(f"bad number of sql_rows: {len(sql_rows)} > {results_per_page}")
-
-                # if debug: logger.debug(f"query_name={query_name!r} query_offset={query_offset}/{num_results}: inserting {len(sql_rows)} rows")
-                # db_cur.executemany(sql_insert_result, sql_rows)
-                # # db_con.commit()
-
-                # time.sleep(1)
-                # sys.exit()
-
-                # await unselect_results()
-
-                # predict next inserted rowid
-                # NOTE this is why: db_con.execute("BEGIN EXCLUSIVE")
-                next_id = db_cur.execute("SELECT COALESCE(MAX(id), 0) FROM telefonbuch_scrape").fetchone()[0] + 1
-                next_id_counter = NextIdCounter(next_id)
-
-                # print(xml_bytes); sys.exit()
-
-                if match := re.search(results_per_page_regex, xml_bytes):
-                    actual_results_per_page = int(match.group(1))
-                    assert actual_results_per_page == results_per_page, \
-                        f"results_per_page: actual={actual_results_per_page} != expected={results_per_page}"
-
-                # parse xml
-                xml_root = lxml.etree.fromstring(xml_bytes)
-
-                # Find all top-level addresses
-                addresses = xml_root.findall(".//entries/address")
-
-                all_rows = []
-                for addr in addresses:
-                    # # Only process top-level (non-child) addresses
-                    # # i.e., skip <address> elements that have an ancestor <address>
-                    # recordtype_elem = addr.find("recordtype")
-                    # if recordtype_elem is not None and recordtype_elem.text == "child":
-                    #     continue
-                    rows = parse_address(addr, next_id_counter)
-                    all_rows.extend(rows)
-
-                # # Prepare executemany data
-                columns = ["id", "parent_id"] + list(telefonbuch_columns.keys())
-                # placeholders = ", ".join(["?" for _ in columns])
-                # insert_sql = f"INSERT INTO addresses ({', '.join(columns)}) VALUES ({placeholders})"
-
-                # sql_rows = [
-                #     tuple(row.get(col) for col in columns)
-                #     for row in all_rows
-                # ]
-
-                sql_rows = []
-                row_query_offset = query_offset
-                query_child_num = 0
-                for row_idx, row in enumerate(all_rows):
-                    if row["parent_id"] is None:
-                        # recordtype="single" or recordtype="parent"
+                        num_pending_rows = len(pending_rows)
+                        row_query_offset = query_offset
                         query_child_num = 0
-                    else:
-                        # recordtype="child"
-                        query_child_num += 1
-                    sql_rows.append((
-                        query_name,
-                        row_query_offset,
-                        query_child_num,
-                        *tuple(row[col] for col in columns)
-                    ))
-                    if row["parent_id"] is None:
-                        # recordtype="single" or recordtype="parent"
-                        row_query_offset += 1
-
-                db_cur.executemany(sql_insert_result, sql_rows)
-
-                progressbar.update(len(sql_rows))
-
-                last_xml_bytes = xml_bytes
-
-            # done query_name
-            # transaction end
-            # atomic inserts per query_name
-            db_con.commit()
-
-            # transaction start
-            # get exclusive write access
-            db_con.execute("BEGIN EXCLUSIVE")
-
-        # done progressbar
+                        for row_idx, row in enumerate(all_rows):
+                            parent_id = row[1]
+                            if parent_id is None:
+                                # recordtype="single" or recordtype="parent"
+                                query_child_num = 0
+                            else:
+                                # recordtype="child"
+                                query_child_num += 1
+                            pending_rows.append((
+                                query_name,
+                                row_query_offset,
+                                query_child_num,
+                                *row
+                            ))
+                            if parent_id is None:
+                                # recordtype="single" or recordtype="parent"
+                                row_query_offset += 1
+
+                        progressbar.update(len(pending_rows) - num_pending_rows)
+
+                        if len(pending_rows) >= pending_rows_limit:
+                            flush_pending_rows()
+
+                        last_xml_root = xml_root
+                finally:
+                    # on error, dont leave the fetch of the next page running
+                    if next_search_results is not None and not next_search_results.done():
+                        next_search_results.cancel()
+
+                # done query_name
+                flush_pending_rows()
+
+                # transaction end
+                # atomic inserts per query_name
+                db_con.commit()
+
+                # transaction start
+                # get exclusive write access
+                db_con.execute("BEGIN EXCLUSIVE")
+
+            # done progressbar
+    finally:
+        # also on error or Ctrl-C, so a partial database gets the index too
+        # the unfinished query_name is discarded, it is scraped again on the next run
+        db_con.rollback()
+        create_query_index()
+        db_con.commit()
 
     # done main
 